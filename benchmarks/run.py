@@ -0,0 +1,250 @@
+"""
+Time the processing pipeline on synthetic plates.
+
+    python -m benchmarks.run --sizes 256 512 --sets 4 16 --output bench.json
+    python -m benchmarks.run --output new.json --compare bench.json
+
+Every (image size, set count) combination gets a freshly generated plate.
+Each stage is timed on its own (index_directory, process_single_image_set
+for every set, normalize.run, plot_results.run) and the whole pipeline is
+timed end to end through pipeline.run_profile, as the app runs it: directory
+index, fingerprints, a cold profile cache and the run directory included.
+Startup is timed in fresh interpreters: creating the app, importing the image
+processing and plotting modules, and starting a pre-warmed worker pool. The
+JSON report keeps the minimum and median of the repeats. With --compare,
+stages slower than the earlier report by more than --threshold are listed
+and the exit status is 1.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from flaskr import create_app, pipeline
+from flaskr.db import init_db
+from flaskr.utils import gastruloid_processing, normalize, options, plot_results, preprocessing
+from flaskr.utils.profile_cache import ProfileCache
+from .synthetic import SUFFIXES, write_plate
+
+BASE_NAME = 'Bench'
+MARKERS = {'red': 'Red', 'green': 'Green', 'cyan': 'Cyan'}
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Code timed in a fresh interpreter for every startup stage
+STARTUP = {
+    'interpreter': "pass",
+    'create_app': "from flaskr import create_app; create_app({{'TESTING': True, 'DATABASE': {database!r}}})",
+    'analysis_modules': "import flaskr.utils.gastruloid_processing, flaskr.utils.plot_results",
+    'worker_pool': "from flaskr.utils import gastruloid_processing as gp; gp.start_pool({workers}); gp.stop_pool()",
+}
+
+
+def _timed(repeat, fn, quiet=True):
+    """Call ``fn`` ``repeat`` times; return the wall times and the last result."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext():
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+    return times, result
+
+
+def _summary(times, sets=None):
+    summary = {'min': min(times), 'median': statistics.median(times), 'runs': times}
+    if sets:
+        summary['per_set_min'] = summary['min'] / sets
+    return summary
+
+
+def bench_startup(args):
+    """Time every startup stage in fresh interpreters, which have nothing imported yet."""
+    stages = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for stage, code in STARTUP.items():
+            code = code.format(database=os.path.join(directory, 'bench.sqlite'), workers=args.workers or 1)
+            times, _ = _timed(args.repeat, lambda: subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True))
+            stages[stage] = _summary(times)
+    return stages
+
+
+def bench_plate(directory, num_sets, size, args):
+    """Time every stage on one synthetic plate and return the report entry."""
+    min_size = args.min_size or max(100, int(6000 * (size / 512) ** 2))
+    options = gastruloid_processing.processing_options(args.segmentation, args.samples, args.dtype)
+    write_plate(directory, num_sets, size=size, bit_depth=args.bit_depth, base_name=BASE_NAME,
+                orientation=args.orientation, polarity=args.polarity, debris=args.debris, seed=args.seed)
+    file_names = [f"{BASE_NAME}_{i}" for i in range(1, num_sets + 1)]
+    quiet = not args.verbose
+
+    stages = {}
+    times, _ = _timed(args.repeat, lambda: preprocessing.index_directory(directory, BASE_NAME, SUFFIXES, 4), quiet)
+    stages['index_directory'] = _summary(times)
+
+    def process_sets():
+        return [
+            gastruloid_processing.process_single_image_set(i, name, directory, SUFFIXES, MARKERS, min_size, **options)
+            for i, name in enumerate(file_names)
+        ]
+    times, profiles = _timed(args.repeat, process_sets, quiet)
+    stages['process_single_image_set'] = _summary(times, num_sets)
+    found = sum(bool(np.any(p[0])) for p in profiles)
+
+    channels = [np.stack([p[c] for p in profiles]) for c in range(4)]
+    results_table = gastruloid_processing.new_results_table(BASE_NAME, range(1, num_sets + 1), MARKERS)
+    times, normalized = _timed(args.repeat, lambda: normalize.run(results_table, *channels), quiet)
+    stages['normalize'] = _summary(times)
+
+    with tempfile.TemporaryDirectory() as plots:
+        times, _ = _timed(args.repeat, lambda: plot_results.run(*normalized, MARKERS, num_sets, plots,
+                                                                workers=args.workers), quiet)
+    stages['plot_results'] = _summary(times, num_sets)
+
+    profile = {
+        'name': BASE_NAME, 'directory': directory, 'base_name': BASE_NAME, 'channels': 4,
+        **{f"{channel}_suffix": suffix for channel, suffix in SUFFIXES.items()},
+        **{f"{channel}_marker": marker for channel, marker in MARKERS.items()},
+        'gastruloid_min_size': min_size, 'segmentation_mode': args.segmentation, 'incremental': 0,
+        'profile_samples': args.samples, 'profile_dtype': args.dtype, 'projection': 'none',
+    }
+
+    def end_to_end():
+        # Every repeat starts from an empty profile cache, like a new plate
+        with tempfile.TemporaryDirectory() as state:
+            timestamp, _, _ = pipeline.run_profile(profile, workers=args.workers,
+                                                   cache=ProfileCache(os.path.join(state, 'cache')), runs_dir=state)
+        shutil.rmtree(os.path.join(pipeline.RESULTS_ROOT, f"{BASE_NAME}_{timestamp}"))
+
+    # run_profile keeps the directory listing in the app's database
+    with tempfile.TemporaryDirectory() as instance:
+        app = create_app({'TESTING': True, 'DATABASE': os.path.join(instance, 'bench.sqlite')})
+        with app.app_context():
+            init_db()
+            times, _ = _timed(args.repeat, end_to_end, quiet)
+    stages['end_to_end'] = _summary(times, num_sets)
+
+    return {
+        'size': size,
+        'sets': num_sets,
+        'bit_depth': args.bit_depth,
+        'gastruloids_found': found,
+        'stages': stages,
+    }
+
+
+def _key(entry):
+    return entry['size'], entry['sets'], entry['bit_depth']
+
+
+def compare(report, baseline, threshold):
+    """
+    Compare the minimum stage times of two reports.
+
+    Returns:
+        regressions (list): ``(size, sets, bit_depth, stage, ratio)`` for every
+            stage more than ``threshold`` (a fraction) slower than the baseline.
+    """
+    previous = {_key(entry): entry for entry in baseline['results']}
+    regressions = []
+    for stage, timing in report['startup'].items():
+        old = baseline.get('startup', {}).get(stage)
+        if old is None:
+            continue
+        ratio = timing['min'] / old['min']
+        print(f"{'startup':>12} {stage:<26} {old['min']:9.3f}s -> {timing['min']:9.3f}s  x{ratio:.2f}", file=sys.stderr)
+        if ratio > 1 + threshold:
+            regressions.append((None, None, None, stage, ratio))
+    for entry in report['results']:
+        old = previous.get(_key(entry))
+        if old is None:
+            continue
+        for stage, timing in entry['stages'].items():
+            if stage not in old['stages']:
+                continue
+            ratio = timing['min'] / old['stages'][stage]['min']
+            print(f"{entry['size']:>6} {entry['sets']:>5} {stage:<26} {old['stages'][stage]['min']:9.3f}s "
+                  f"-> {timing['min']:9.3f}s  x{ratio:.2f}", file=sys.stderr)
+            if ratio > 1 + threshold:
+                regressions.append(_key(entry) + (stage, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512], help='Image widths/heights in pixels.')
+    parser.add_argument('--sets', type=int, nargs='+', default=[4], help='Image set counts per plate.')
+    parser.add_argument('--bit-depth', type=int, choices=(8, 16), default=8)
+    parser.add_argument('--orientation', type=float, default=None,
+                        help='Angle of every gastruloid\'s A-P axis in degrees [default: random per set].')
+    parser.add_argument('--polarity', type=int, choices=(-1, 1), default=None,
+                        help='Direction of the posterior along that axis [default: random per set].')
+    parser.add_argument('--debris', type=int, default=3, help='Bright specks outside each gastruloid.')
+    parser.add_argument('--segmentation', choices=options.SEGMENTATION_MODES, default='full')
+    parser.add_argument('--samples', type=int, default=options.DEFAULT_SAMPLES)
+    parser.add_argument('--dtype', choices=options.PROFILE_DTYPES, default=options.DEFAULT_DTYPE)
+    parser.add_argument('--min-size', type=int, default=None,
+                        help='Minimum gastruloid size [default: 6000 scaled to the image size].')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes for the end-to-end and plot stages and the startup worker pool.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON report here (default: stdout).')
+    parser.add_argument('--compare', help='Earlier JSON report to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Allowed slowdown against --compare, as a fraction.')
+    parser.add_argument('--verbose', action='store_true', help="Show the pipeline's own output.")
+    args = parser.parse_args(argv)
+
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'verbose')},
+        'startup': bench_startup(args),
+        'results': [],
+    }
+    print('startup: ' + ', '.join(f"{stage} {timing['min']:.3f}s" for stage, timing in report['startup'].items()),
+          file=sys.stderr)
+    for size in args.sizes:
+        for num_sets in args.sets:
+            with tempfile.TemporaryDirectory() as directory:
+                entry = bench_plate(directory, num_sets, size, args)
+            report['results'].append(entry)
+            print(f"size {size}, {num_sets} sets: " + ', '.join(
+                f"{stage} {timing['min']:.3f}s" for stage, timing in entry['stages'].items()
+            ), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for size, sets, bit_depth, stage, ratio in regressions:
+            where = f"at size {size}, {sets} sets" if size is not None else "at startup"
+            print(f"REGRESSION: {stage} {where} is x{ratio:.2f} slower", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
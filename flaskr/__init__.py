@@ -1,6 +1,7 @@
 import os
 from flask import (Flask, flash, redirect, render_template, url_for)
-from . import db, setup
+from . import batch, db, jobs, pipeline, results, setup, upload, watch
+from .utils import run_store
 from flaskr.db import get_db
 
 
@@ -9,7 +10,34 @@ def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY = 'dev',
-        DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite')
+        DATABASE=os.path.join(app.instance_path, 'flaskr.sqlite'),
+        # Number of processes used to analyse image sets in parallel
+        PROCESS_WORKERS=os.cpu_count() or 1,
+        # Number of analysis runs executed concurrently in the background
+        JOB_WORKERS=1,
+        # Start PROCESS_WORKERS analysis processes in the background at startup
+        # and share them between runs, so the first run does not wait for
+        # processes to spawn and import the image processing modules
+        PREWARM_POOL=False,
+        # On-disk cache of per-set profiles reused across runs; set the
+        # directory to None to disable it
+        PROFILE_CACHE_DIR=os.path.join(app.instance_path, 'profile_cache'),
+        PROFILE_CACHE_MAX_BYTES=2 * 1024 ** 3,
+        # Per-run state (raw profiles, input fingerprints) used by incremental runs
+        RUNS_DIR=os.path.join(app.instance_path, 'runs'),
+        # Rendered QC montages (/results/<profile>/<timestamp>/qc/<set>.png);
+        # set the directory to None to render them on every request
+        QC_CACHE_DIR=os.path.join(app.instance_path, 'qc_cache'),
+        QC_CACHE_MAX_BYTES=256 * 1024 ** 2,
+        # Live runs refresh a heartbeat this often; runs that miss it for
+        # RUN_STALE_SECONDS are treated as abandoned by a dead process
+        RUN_HEARTBEAT_SECONDS=10,
+        RUN_STALE_SECONDS=60,
+        # Record wall/CPU time per pipeline stage and image set for every run
+        # (shown at /results/<profile>/<timestamp>/profile); memory tracing
+        # adds peak traced memory but slows runs down
+        INSTRUMENT_RUNS=False,
+        INSTRUMENT_MEMORY=False,
     )
     if test_config is None:
         # load the instance config, if it exists, when not testing
@@ -24,8 +52,16 @@ def create_app(test_config=None):
         pass
 
     db.init_app(app)
+    pipeline.init_app(app)
+    batch.init_app(app)
+    watch.init_app(app)
+    results.init_app(app)
+    if app.config['PREWARM_POOL']:
+        jobs.prewarm(app)
 
     app.register_blueprint(setup.bp)
+    app.register_blueprint(results.bp)
+    app.register_blueprint(upload.bp)
 
     @app.route('/hello')
     def hello():
@@ -45,18 +81,33 @@ def create_app(test_config=None):
             flash("Profile not found.")
             return redirect(url_for('setup.prompt'))
 
-        directory = os.path.join(
-            os.path.dirname(__file__), 'static', 'results', f"{profile_name}_{timestamp}"
-        )
+        run = db.execute(
+            "SELECT num_sets, data_dir, failed_sets FROM runs WHERE profile_id = ? AND timestamp = ? AND status = 'done'",
+            (profile['id'], timestamp)
+        ).fetchone()
 
-        # Count how many individual result images exist
-        num_sets = len([f for f in os.listdir(directory) if f.startswith("set_") and f.endswith(".png")])
+        set_numbers = None
+        failed = {}
+        if run is not None and run['num_sets'] is not None:
+            num_sets = run['num_sets']
+            failed = jobs.failed_sets(run)
+            if run['data_dir'] is not None:
+                # Set numbers link each plot to its QC montage
+                set_numbers = run_store.load_meta(run['data_dir'])['set_numbers']
+        else:
+            # Results from before runs were recorded: count the individual result images
+            directory = os.path.join(
+                os.path.dirname(__file__), 'static', 'results', f"{profile_name}_{timestamp}"
+            )
+            num_sets = len([f for f in os.listdir(directory) if f.startswith("set_") and f.endswith(".png")])
 
         return render_template(
             'show_results.html',
             profile_name=profile_name,
             timestamp=timestamp,
             num_sets=num_sets,
+            set_numbers=set_numbers,
+            failed_sets=failed,
             cyan_marker=bool(profile["cyan_marker"])
         )
 
@@ -0,0 +1,257 @@
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from . import jobs
+from .utils import options
+from flaskr.db import get_db
+
+# Profile settings a manifest entry may set
+PROFILE_COLUMNS = (
+    'directory', 'base_name', 'channels',
+    'dapi_suffix', 'red_suffix', 'green_suffix', 'cyan_suffix',
+    'red_marker', 'green_marker', 'cyan_marker',
+    'gastruloid_min_size', 'segmentation_mode', 'incremental', 'profile_samples', 'profile_dtype', 'projection',
+)
+
+REQUIRED_COLUMNS = PROFILE_COLUMNS[:10]
+
+
+def load_manifest(path):
+    """
+    Read a JSON manifest: a list whose entries are either profile names or
+    objects with profile settings.
+
+    An object may name a ``template`` profile whose settings are copied and
+    overridden by the entry, so a plate only needs its ``directory``, e.g.
+    ``{"template": "Default", "directory": "/data/plate7"}``. Without a
+    ``name`` the profile is called after the template and the directory.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, list):
+        raise click.ClickException("The manifest must be a JSON list.")
+    return manifest
+
+
+def _profile_id(db, entry):
+    """Return the profile id for a manifest entry, creating or updating the profile."""
+    if isinstance(entry, str):
+        entry = {'name': entry}
+    settings = {}
+
+    template = entry.get('template')
+    if template is not None:
+        row = db.execute("SELECT * FROM profiles WHERE name = ?", (template,)).fetchone()
+        if row is None:
+            raise click.ClickException(f"Template profile '{template}' not found.")
+        settings.update({column: row[column] for column in PROFILE_COLUMNS})
+
+    name = entry.get('name')
+    if name is None:
+        if template is None or 'directory' not in entry:
+            raise click.ClickException(f"Manifest entry needs a name: {entry}")
+        name = f"{template}_{os.path.basename(os.path.normpath(entry['directory']))}"
+    settings.update({column: entry[column] for column in PROFILE_COLUMNS if column in entry})
+
+    existing = db.execute("SELECT * FROM profiles WHERE name = ?", (name,)).fetchone()
+    if not settings:
+        if existing is None:
+            raise click.ClickException(f"Profile '{name}' not found.")
+        return existing['id']
+
+    if existing is not None:
+        settings = {**{column: existing[column] for column in PROFILE_COLUMNS}, **settings}
+    missing = [column for column in REQUIRED_COLUMNS if not settings.get(column)]
+    if missing:
+        raise click.ClickException(f"Profile '{name}' is missing: {', '.join(missing)}")
+    try:
+        options.processing_options(
+            settings.get('segmentation_mode', 'full'),
+            settings.get('profile_samples', options.DEFAULT_SAMPLES),
+            settings.get('profile_dtype', options.DEFAULT_DTYPE),
+            settings.get('projection', 'none'),
+        )
+    except ValueError as e:
+        raise click.ClickException(f"Profile '{name}': {e}")
+
+    columns = list(settings)
+    if existing is not None:
+        db.execute(
+            f"UPDATE profiles SET {', '.join(f'{c} = ?' for c in columns)} WHERE id = ?",
+            [settings[c] for c in columns] + [existing['id']]
+        )
+        return existing['id']
+    cursor = db.execute(
+        f"INSERT INTO profiles (name, {', '.join(columns)}) VALUES (?{', ?' * len(columns)})",
+        [name] + [settings[c] for c in columns]
+    )
+    return cursor.lastrowid
+
+
+def create_batch(entries):
+    """Record a batch with one pending job per profile entry and return its id."""
+    db = get_db()
+    profile_ids = [_profile_id(db, entry) for entry in entries]
+    cursor = db.execute("INSERT INTO batches (status) VALUES ('running')")
+    batch_id = cursor.lastrowid
+    db.executemany(
+        "INSERT INTO batch_jobs (batch_id, profile_id) VALUES (?, ?)",
+        [(batch_id, profile_id) for profile_id in profile_ids]
+    )
+    db.commit()
+    return batch_id
+
+
+def resume_batch(batch_id):
+    """
+    Prepare an interrupted batch for another pass.
+
+    Runs left queued or running by a process that is gone (no recent
+    heartbeat) are marked failed, and every job that did not finish is set
+    back to pending. Jobs whose run is still live in another process are
+    left to that process.
+    """
+    db = get_db()
+    if db.execute("SELECT id FROM batches WHERE id = ?", (batch_id,)).fetchone() is None:
+        raise click.ClickException(f"Batch {batch_id} not found.")
+    stale_after = jobs._stale_after(current_app)
+    db.execute(
+        "UPDATE runs SET status = 'failed', error = 'interrupted', finished = CURRENT_TIMESTAMP"
+        " WHERE status IN ('queued', 'running') AND heartbeat <= datetime('now', ?)"
+        " AND id IN (SELECT run_id FROM batch_jobs WHERE batch_id = ?)",
+        (stale_after, batch_id)
+    )
+    db.execute(
+        "UPDATE batch_jobs SET status = 'pending' WHERE batch_id = ? AND status != 'done' AND (run_id IS NULL"
+        " OR run_id NOT IN (SELECT id FROM runs WHERE status IN ('queued', 'running')))",
+        (batch_id,)
+    )
+    db.execute("UPDATE batches SET status = 'running', finished = NULL WHERE id = ?", (batch_id,))
+    db.commit()
+
+
+def _run_job(app, job_id, workers):
+    with app.app_context():
+        db = get_db()
+        job = db.execute("SELECT * FROM batch_jobs WHERE id = ?", (job_id,)).fetchone()
+        # Coordinated with runs started from the web, the watcher and uploads:
+        # identical inputs that are being processed or were already are not
+        # processed again
+        run_id, outcome = jobs.reserve_run(job['profile_id'])
+        db.execute("UPDATE batch_jobs SET run_id = ?, status = 'running' WHERE id = ?", (run_id, job_id))
+        db.commit()
+        if outcome == 'attached':
+            jobs.wait_for_run(run_id)
+
+    if outcome == 'started':
+        jobs.execute_run(app, run_id, workers=workers)
+
+    with app.app_context():
+        db = get_db()
+        run = db.execute(
+            "SELECT r.*, p.name AS profile_name FROM runs r JOIN profiles p ON p.id = r.profile_id WHERE r.id = ?",
+            (run_id,)
+        ).fetchone()
+        db.execute("UPDATE batch_jobs SET status = ? WHERE id = ?", (run['status'], job_id))
+        db.commit()
+        return run
+
+
+def run_batch(batch_id, jobs_at_once=1, workers_per_job=None):
+    """
+    Run a batch's pending jobs, ``jobs_at_once`` at a time.
+
+    Each job is an ordinary run of one profile using ``workers_per_job``
+    processes, so at most ``jobs_at_once * workers_per_job`` processes are
+    busy analysing image sets.
+
+    Returns:
+        counts (dict): Number of jobs per final run status.
+    """
+    app = current_app._get_current_object()
+    db = get_db()
+    pending = [row['id'] for row in db.execute(
+        "SELECT id FROM batch_jobs WHERE batch_id = ? AND status = 'pending' ORDER BY id", (batch_id,)
+    )]
+
+    counts = {}
+    executor = ThreadPoolExecutor(max_workers=jobs_at_once, thread_name_prefix='flaskr-batch')
+    futures = {executor.submit(_run_job, app, job_id, workers_per_job): job_id for job_id in pending}
+    try:
+        for n, future in enumerate(as_completed(futures), start=1):
+            try:
+                run = future.result()
+            except Exception as e:
+                # One job going wrong outside its run (e.g. its profile was
+                # deleted) should not stop the others
+                db.execute("UPDATE batch_jobs SET status = 'failed' WHERE id = ?", (futures[future],))
+                db.commit()
+                counts['failed'] = counts.get('failed', 0) + 1
+                click.echo(f"[{n}/{len(pending)}] job {futures[future]}: failed ({e})")
+                continue
+            counts[run['status']] = counts.get(run['status'], 0) + 1
+            detail = f"{run['num_sets']} sets, {run['timestamp']}" if run['status'] == 'done' else run['error']
+            click.echo(f"[{n}/{len(pending)}] {run['profile_name']}: {run['status']} ({detail})")
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        click.echo(f"Interrupted; resume with: flask batch-run --resume {batch_id}")
+        sys.stdout.flush()
+        # Exiting normally would join the executor's threads and so wait for
+        # the runs in flight; they are abandoned instead, and --resume marks
+        # them failed and runs their jobs again
+        os._exit(130)
+    executor.shutdown()
+
+    unfinished = db.execute(
+        "SELECT COUNT(*) FROM batch_jobs WHERE batch_id = ? AND status != 'done'", (batch_id,)
+    ).fetchone()[0]
+    db.execute(
+        "UPDATE batches SET status = ?, finished = CURRENT_TIMESTAMP WHERE id = ?",
+        ('done' if not unfinished else 'incomplete', batch_id)
+    )
+    db.commit()
+    return counts
+
+
+@click.command('batch-run')
+@click.argument('profile_names', nargs=-1)
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False),
+              help='JSON list of profile names or profile settings (see load_manifest).')
+@click.option('--jobs', 'jobs_at_once', type=click.IntRange(min=1), default=None,
+              help='Profiles processed at the same time [default: JOB_WORKERS].')
+@click.option('--workers-per-job', type=click.IntRange(min=1), default=None,
+              help='Processes per profile [default: PROCESS_WORKERS divided among the jobs].')
+@click.option('--resume', 'resume_id', type=int, default=None,
+              help='Re-run the unfinished jobs of an earlier batch.')
+@with_appcontext
+def batch_run_command(profile_names, manifest, jobs_at_once, workers_per_job, resume_id):
+    """Analyse many profiles without the web interface."""
+    if resume_id is not None:
+        if profile_names or manifest:
+            raise click.UsageError("--resume cannot be combined with profiles or a manifest.")
+        resume_batch(resume_id)
+        batch_id = resume_id
+    else:
+        entries = list(profile_names) + (load_manifest(manifest) if manifest else [])
+        if not entries:
+            raise click.UsageError("Give profile names, a --manifest or --resume.")
+        batch_id = create_batch(entries)
+
+    jobs_at_once = jobs_at_once or current_app.config['JOB_WORKERS']
+    workers_per_job = workers_per_job or max(1, current_app.config['PROCESS_WORKERS'] // jobs_at_once)
+    click.echo(f"Batch {batch_id}: {jobs_at_once} job(s) at a time, {workers_per_job} worker(s) each")
+
+    counts = run_batch(batch_id, jobs_at_once, workers_per_job)
+    click.echo(f"Batch {batch_id} finished: " + ', '.join(f"{n} {status}" for status, n in sorted(counts.items())))
+    if counts.get('failed'):
+        click.echo(f"Retry the failed jobs with: flask batch-run --resume {batch_id}")
+
+
+def init_app(app):
+    app.cli.add_command(batch_run_command)
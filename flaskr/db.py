@@ -1,32 +1,109 @@
 import sqlite3
+import threading
 from datetime import datetime
 
 import click
 from flask import current_app, g
 
+# Idle connections per database, shared by all threads: a request checks
+# one out and hands it back when its app context ends. Threaded servers
+# start a thread per request, so connections cannot be kept per thread.
+POOL_SIZE = 8
+_pool = {}
+_pool_lock = threading.Lock()
+
+
+class _Connection(sqlite3.Connection):
+    # (data_version, total_changes) when this connection last validated
+    # the profile cache, see _profile_rows
+    profile_token = None
+
+
+def _connect(path):
+    # Used by one thread at a time, but not always the one that opened it
+    db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False, factory=_Connection)
+    db.row_factory = sqlite3.Row
+    # WAL lets readers (status polls, result pages) proceed while a run writes
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        path = current_app.config['DATABASE']
+        with _pool_lock:
+            idle = _pool.get(path)
+            db = idle.pop() if idle else None
+        g.db = db if db is not None else _connect(path)
+        g.db_path = path
 
     return g.db
 
 
 def close_db(e=None):
     db = g.pop('db', None)
+    if db is None:
+        return
+
+    # Work left uncommitted is discarded, as closing the connection would
+    # have done, before it goes back to the pool for the next request
+    if db.in_transaction:
+        db.rollback()
+    with _pool_lock:
+        idle = _pool.setdefault(g.pop('db_path'), [])
+        if len(idle) < POOL_SIZE:
+            idle.append(db)
+            return
+    db.close()
+
 
-    if db is not None:
-        db.close()
+# Rows of the profiles table by database and id, shared by every thread of
+# the process: {path: {'version': ..., 'rows': {id: row}}}
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+
+def _profile_rows(db, path):
+    """Return the cached rows for ``path``, emptied if the table changed since they were read."""
+    # data_version moves when another connection commits and total_changes
+    # when this one writes; only then is the trigger-maintained version read
+    token = (db.execute("PRAGMA data_version").fetchone()[0], db.total_changes)
+    with _profiles_lock:
+        cache = _profiles.setdefault(path, {'version': None, 'rows': {}})
+    if db.profile_token == token:
+        return cache['rows']
+
+    version = db.execute("SELECT version FROM profiles_version").fetchone()[0]
+    with _profiles_lock:
+        if version != cache['version']:
+            cache['rows'].clear()
+            cache['version'] = version
+    db.profile_token = token
+    return cache['rows']
+
+
+def get_profile(profile_id):
+    """Return the ``profiles`` row with the given id, or None, from a process-wide cache."""
+    db = get_db()
+    rows = _profile_rows(db, current_app.config['DATABASE'])
+    with _profiles_lock:
+        if profile_id in rows:
+            return rows[profile_id]
+    profile = db.execute("SELECT * FROM profiles WHERE id = ?", (profile_id,)).fetchone()
+    if profile is not None:
+        with _profiles_lock:
+            rows[profile_id] = profile
+    return profile
 
 def init_db():
     db = get_db()
 
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
+    # The version counter starts over with the new tables
+    with _profiles_lock:
+        _profiles.pop(current_app.config['DATABASE'], None)
 
 
 @click.command('init-db')
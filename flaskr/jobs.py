@@ -0,0 +1,389 @@
+import contextlib
+import datetime
+import importlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from . import pipeline
+from .utils import instrumentation
+from .utils.profile_cache import ProfileCache
+from flaskr.db import get_db, get_profile
+
+_executor = None
+
+
+def get_executor(app):
+    """Return the process-wide executor that runs analysis jobs."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=app.config['JOB_WORKERS'], thread_name_prefix='flaskr-job'
+        )
+    return _executor
+
+
+def prewarm(app):
+    """
+    Load the analysis modules and start the shared worker pool in the background.
+
+    The app itself starts without them; this only moves their cost from the
+    first run to idle time after startup.
+    """
+    def warm():
+        from .utils import gastruloid_processing
+        # Only imported, so the first run's plots do not wait for matplotlib
+        importlib.import_module('.utils.plot_results', __package__)
+        started = time.perf_counter()
+        gastruloid_processing.start_pool(app.config['PROCESS_WORKERS'])
+        print(f"Worker pool of {app.config['PROCESS_WORKERS']} processes ready "
+              f"in {time.perf_counter() - started:.1f}s")
+
+    threading.Thread(target=warm, name='flaskr-prewarm', daemon=True).start()
+
+
+def get_profile_cache(app):
+    """Return a ProfileCache configured from the app, or None if caching is disabled."""
+    if not app.config['PROFILE_CACHE_DIR']:
+        return None
+    return ProfileCache(app.config['PROFILE_CACHE_DIR'], app.config['PROFILE_CACHE_MAX_BYTES'])
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+# Runs queued or running in this process. A daemon thread refreshes their
+# heartbeat so other processes can tell live runs from ones whose process
+# died (see RUN_STALE_SECONDS).
+_owned = set()
+_owned_lock = threading.Lock()
+_heartbeat_thread = None
+
+
+def _heartbeat(app):
+    with app.app_context():
+        while True:
+            time.sleep(app.config['RUN_HEARTBEAT_SECONDS'])
+            with _owned_lock:
+                run_ids = list(_owned)
+            if not run_ids:
+                continue
+            db = get_db()
+            try:
+                db.execute(
+                    f"UPDATE runs SET heartbeat = CURRENT_TIMESTAMP WHERE id IN ({', '.join('?' * len(run_ids))})",
+                    run_ids
+                )
+                db.commit()
+            except sqlite3.OperationalError:
+                # Database busy; the next beat will do
+                db.rollback()
+
+
+def _own(app, run_id):
+    global _heartbeat_thread
+    with _owned_lock:
+        _owned.add(run_id)
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_heartbeat, args=(app,), name='flaskr-heartbeat', daemon=True)
+            _heartbeat_thread.start()
+
+
+def _disown(run_id):
+    with _owned_lock:
+        _owned.discard(run_id)
+
+
+def _stale_after(app):
+    # Modifier for SQLite's datetime('now', ...)
+    return f"-{int(app.config['RUN_STALE_SECONDS'])} seconds"
+
+
+@contextlib.contextmanager
+def _immediate(db):
+    """
+    Run the block in a write transaction taken up front.
+
+    SQLite allows one writer at a time across every process using the
+    database, so check-then-insert sequences inside the block are atomic.
+    """
+    db.commit()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+
+
+def _insert_run(db, profile_id, input_key=None):
+    cursor = db.execute(
+        "INSERT INTO runs (profile_id, status, stage, input_key, heartbeat)"
+        " VALUES (?, 'queued', 'queued', ?, CURRENT_TIMESTAMP)",
+        (profile_id, input_key)
+    )
+    return cursor.lastrowid
+
+
+def create_run(profile_id, input_key=None):
+    """Record a queued run for a profile, owned by this process, and return its id."""
+    db = get_db()
+    run_id = _insert_run(db, profile_id, input_key)
+    db.commit()
+    _own(current_app._get_current_object(), run_id)
+    return run_id
+
+
+def reserve_run(profile_id, force=False, only_sets=None, coalesce=False):
+    """
+    Record a run for a profile unless one with identical inputs exists.
+
+    A queued or running run with the same input key (see pipeline.input_key)
+    whose heartbeat is fresh is attached to; otherwise the latest finished
+    run with that key is reused unless ``force`` is set. With ``coalesce``
+    a live run of the profile that has not started yet is attached to as
+    well and takes over the new key, since it only scans the directory once
+    it starts. The check and the insert happen in one write transaction, so
+    concurrent callers, even in different processes, end up with the same
+    run.
+
+    Returns:
+        run_id (int): The run to follow.
+        outcome (str): 'started' for a new run, which the caller executes
+            (see execute_run), 'attached' or 'reused'.
+    """
+    app = current_app._get_current_object()
+    db = get_db()
+    profile = get_profile(profile_id)
+    key = pipeline.input_key(profile, only_sets)
+
+    with _immediate(db):
+        run = db.execute(
+            "SELECT id FROM runs WHERE profile_id = ? AND input_key = ? AND status IN ('queued', 'running')"
+            " AND heartbeat > datetime('now', ?) ORDER BY id DESC LIMIT 1",
+            (profile_id, key, _stale_after(app))
+        ).fetchone()
+        if run is not None:
+            return run['id'], 'attached'
+
+        if not force:
+            run = db.execute(
+                "SELECT id, data_dir FROM runs WHERE profile_id = ? AND input_key = ? AND status = 'done'"
+                " ORDER BY id DESC LIMIT 1",
+                (profile_id, key)
+            ).fetchone()
+            if run is not None and run['data_dir'] and os.path.isdir(run['data_dir']):
+                return run['id'], 'reused'
+
+        if coalesce and only_sets is None:
+            run = db.execute(
+                "SELECT id FROM runs WHERE profile_id = ? AND status = 'queued' AND heartbeat > datetime('now', ?)"
+                " ORDER BY id DESC LIMIT 1",
+                (profile_id, _stale_after(app))
+            ).fetchone()
+            if run is not None:
+                db.execute("UPDATE runs SET input_key = ? WHERE id = ?", (key, run['id']))
+                return run['id'], 'attached'
+
+        # Runs whose process stopped beating will never finish
+        db.execute(
+            "UPDATE runs SET status = 'failed', error = 'abandoned: no heartbeat', finished = CURRENT_TIMESTAMP"
+            " WHERE profile_id = ? AND status IN ('queued', 'running') AND heartbeat <= datetime('now', ?)",
+            (profile_id, _stale_after(app))
+        )
+        run_id = _insert_run(db, profile_id, key)
+
+    _own(app, run_id)
+    return run_id, 'started'
+
+
+def submit_run(profile_id, force=False, coalesce=False, **options):
+    """
+    Start a run for a profile in the background unless one with identical
+    inputs exists (see reserve_run).
+
+    Keyword arguments other than ``force`` and ``coalesce`` are passed on to
+    execute_run.
+
+    Returns:
+        run_id (int): The run to follow.
+        outcome (str): 'started', 'attached' or 'reused'.
+    """
+    run_id, outcome = reserve_run(profile_id, force, options.get('only_sets'), coalesce)
+    if outcome == 'started':
+        app = current_app._get_current_object()
+        get_executor(app).submit(execute_run, app, run_id, **options)
+    return run_id, outcome
+
+
+def is_live(db, run_id):
+    """True while the run is queued or running in a process that still beats."""
+    return db.execute(
+        "SELECT 1 FROM runs WHERE id = ? AND status IN ('queued', 'running') AND heartbeat > datetime('now', ?)",
+        (run_id, _stale_after(current_app))
+    ).fetchone() is not None
+
+
+def wait_for_run(run_id, interval=1.0):
+    """
+    Block until a run started elsewhere has finished; return its row.
+
+    A run whose process stops beating is marked failed, as submit_run does.
+    """
+    db = get_db()
+    while is_live(db, run_id):
+        time.sleep(interval)
+    db.execute(
+        "UPDATE runs SET status = 'failed', error = 'abandoned: no heartbeat', finished = CURRENT_TIMESTAMP"
+        " WHERE id = ? AND status IN ('queued', 'running')",
+        (run_id,)
+    )
+    db.commit()
+    return db.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+
+
+def _claim(app, db, run_id, profile_id):
+    """Mark the run as running once no other live run of the same profile is running."""
+    waiting = False
+    while True:
+        with _immediate(db):
+            busy = db.execute(
+                "SELECT id FROM runs WHERE profile_id = ? AND id != ? AND status = 'running'"
+                " AND heartbeat > datetime('now', ?)",
+                (profile_id, run_id, _stale_after(app))
+            ).fetchone()
+            if busy is None:
+                db.execute(
+                    "UPDATE runs SET status = 'running', started = CURRENT_TIMESTAMP, heartbeat = CURRENT_TIMESTAMP"
+                    " WHERE id = ?",
+                    (run_id,)
+                )
+                return
+            if not waiting:
+                db.execute("UPDATE runs SET stage = 'waiting' WHERE id = ?", (run_id,))
+                waiting = True
+        time.sleep(1)
+
+
+def execute_run(app, run_id, workers=None, **options):
+    """
+    Run a queued run to completion in its own app context, recording the outcome.
+
+    ``workers`` overrides the app's PROCESS_WORKERS for this run; other
+    keyword arguments are passed on to pipeline.run_profile.
+    """
+    _own(app, run_id)
+    try:
+        _execute(app, run_id, workers, options)
+    finally:
+        _disown(run_id)
+
+
+def _execute(app, run_id, workers, options):
+    with app.app_context():
+        db = get_db()
+        profile = db.execute(
+            "SELECT p.* FROM profiles p JOIN runs r ON r.profile_id = p.id WHERE r.id = ?",
+            (run_id,)
+        ).fetchone()
+        if profile is None:
+            # The profile was deleted while its run was queued
+            db.execute(
+                "UPDATE runs SET status = 'failed', error = 'profile not found', finished = CURRENT_TIMESTAMP"
+                " WHERE id = ?",
+                (run_id,)
+            )
+            db.commit()
+            return
+        # One run per profile at a time, so incremental runs build on each other
+        _claim(app, db, run_id, profile['id'])
+
+        def progress(stage, done=None, total=None):
+            db.execute(
+                "UPDATE runs SET stage = ?, sets_done = COALESCE(?, sets_done),"
+                " sets_total = COALESCE(?, sets_total) WHERE id = ?",
+                (stage, done, total, run_id)
+            )
+            db.commit()
+
+        previous = db.execute(
+            "SELECT timestamp FROM runs WHERE profile_id = ? AND status = 'done' ORDER BY id DESC LIMIT 1",
+            (profile['id'],)
+        ).fetchone()
+
+        cache = get_profile_cache(app)
+        recorder = None
+        if app.config['INSTRUMENT_RUNS']:
+            recorder = instrumentation.Recorder(memory=app.config['INSTRUMENT_MEMORY'])
+        try:
+            with instrumentation.recording(recorder):
+                timestamp, num_sets, failed = pipeline.run_profile(
+                    profile, workers=workers or app.config['PROCESS_WORKERS'], progress=progress, cache=cache,
+                    runs_dir=app.config['RUNS_DIR'], previous=previous['timestamp'] if previous else None,
+                    **options
+                )
+        except Exception as e:
+            traceback.print_exc()
+            db.execute(
+                "UPDATE runs SET status = 'failed', error = ?, finished = CURRENT_TIMESTAMP WHERE id = ?",
+                (str(e), run_id)
+            )
+        else:
+            # Sets that failed in a worker are kept on the run rather than failing it
+            db.execute(
+                "UPDATE runs SET status = 'done', stage = 'done', timestamp = ?, num_sets = ?, data_dir = ?,"
+                " failed_sets = ?, finished = CURRENT_TIMESTAMP WHERE id = ?",
+                (timestamp, num_sets, os.path.join(app.config['RUNS_DIR'], f"{profile['name']}_{timestamp}"),
+                 json.dumps(failed) if failed else None, run_id)
+            )
+        if cache is not None:
+            db.execute(
+                "UPDATE runs SET cache_hits = ?, cache_misses = ? WHERE id = ?",
+                (cache.hits, cache.misses, run_id)
+            )
+        if recorder is not None:
+            db.executemany(
+                "INSERT INTO run_stages (run_id, stage, set_name, wall_seconds, cpu_seconds, peak_bytes)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [(run_id, r['stage'], r['set_name'], r['wall_seconds'], r['cpu_seconds'], r['peak_bytes'])
+                 for r in recorder.records]
+            )
+        db.commit()
+
+
+def failed_sets(run):
+    """Error message of each image set a finished run could not process, by set name."""
+    return json.loads(run['failed_sets']) if run['failed_sets'] else {}
+
+
+def run_status(run):
+    """Summarise a ``runs`` row as a JSON-serialisable dict, including an ETA."""
+    elapsed = eta = None
+    if run['started'] is not None:
+        end = run['finished'] or _utcnow()
+        elapsed = (end - run['started']).total_seconds()
+        done, total = run['sets_done'], run['sets_total']
+        if run['status'] == 'running' and run['stage'] == 'segmenting' and done and total:
+            eta = elapsed / done * (total - done)
+
+    return {
+        'id': run['id'],
+        'status': run['status'],
+        'stage': run['stage'],
+        'sets_done': run['sets_done'],
+        'sets_total': run['sets_total'],
+        'elapsed_seconds': elapsed,
+        'eta_seconds': eta,
+        'error': run['error'],
+        'failed_sets': failed_sets(run),
+        'cache_hits': run['cache_hits'],
+        'cache_misses': run['cache_misses'],
+    }
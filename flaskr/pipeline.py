@@ -0,0 +1,356 @@
+import datetime
+import hashlib
+import itertools
+import json
+import os
+import shutil
+
+import click
+import numpy as np
+from flask.cli import with_appcontext
+
+from .utils import preprocessing, instrumentation, normalize, options, run_store
+from .utils.profile_cache import file_identity
+from flaskr.db import get_db
+
+
+RESULTS_ROOT = os.path.join(os.path.dirname(__file__), 'static', 'results')
+
+
+def _noop(stage, done=None, total=None):
+    pass
+
+
+def channel_suffixes(profile):
+    return {
+        'dapi': profile['dapi_suffix'],
+        'red': profile['red_suffix'],
+        'green': profile['green_suffix'],
+        'cyan': profile['cyan_suffix']
+    }
+
+
+def marker_names(profile):
+    return {
+        'red': profile['red_marker'],
+        'green': profile['green_marker'],
+        'cyan': profile['cyan_marker']
+    }
+
+
+def scan_profile(profile, force=False):
+    """Index the profile's directory into image sets, reusing the stored listing when unchanged."""
+    return preprocessing.index_directory(
+        profile['directory'], profile['base_name'], channel_suffixes(profile), int(profile['channels']),
+        db=get_db(), force=force
+    )
+
+
+def input_key(profile, only_sets=None):
+    """
+    Identify everything a run of the profile depends on: its settings, the
+    analysis version and the names, sizes and mtimes of the set files.
+
+    Two runs with the same key produce the same results. The files are
+    stat'ed afresh: the stored listing only notices files being added or
+    removed, not a file rewritten in place.
+    """
+    index = scan_profile(profile)
+    set_numbers = index.complete_sets
+    if only_sets is not None:
+        wanted = set(only_sets)
+        set_numbers = [n for n in set_numbers if n in wanted]
+    payload = {
+        'settings': {column: profile[column] for column in profile.keys() if column != 'id'},
+        'version': options.ALGORITHM_VERSION,
+        'files': [
+            [name, file_identity(os.path.join(profile['directory'], name))]
+            for n in set_numbers for name in sorted(index.sets[n].values())
+        ],
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def _load_state(run_dir):
+    try:
+        with np.load(os.path.join(run_dir, 'state.npz')) as data:
+            state = {name: data[name] for name in data.files}
+        state['raw'] = run_store.load_array(run_dir, 'raw')
+    except OSError:
+        return None
+    return state
+
+
+def _plot_digest(*arrays, labels=()):
+    digest = hashlib.blake2b(digest_size=16)
+    for label in labels:
+        digest.update(str(label).encode('utf8'))
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def _reuse_plot(source, destination):
+    # Hard links are free and safe because plots are never modified in place
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def _reserve_timestamp(profile_name, runs_dir=None):
+    """
+    Return a timestamp no other run of the profile has used.
+
+    The run's results (and run) directory is created here, so runs started
+    within the same second get ``_2``, ``_3``... suffixes instead of writing
+    into each other's directories.
+    """
+    base = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    for n in itertools.count(1):
+        timestamp = base if n == 1 else f"{base}_{n}"
+        try:
+            os.makedirs(os.path.join(RESULTS_ROOT, f"{profile_name}_{timestamp}"))
+        except FileExistsError:
+            continue
+        if runs_dir:
+            os.makedirs(runs_dir, exist_ok=True)
+            try:
+                os.mkdir(os.path.join(runs_dir, f"{profile_name}_{timestamp}"))
+            except FileExistsError:
+                continue
+        return timestamp
+
+
+def run_profile(profile, workers=None, progress=None, cache=None, runs_dir=None, previous=None, only_sets=None,
+                incremental=None):
+    """
+    Run the full analysis for a profile row and write its result plots.
+
+    Args:
+        profile: Row from the ``profiles`` table.
+        workers (int): Number of processes used for image set analysis.
+        progress (callable): Called as ``progress(stage, done, total)`` when
+            the pipeline changes stage or finishes an image set.
+        cache (ProfileCache): Optional cache of per-set profiles.
+        runs_dir (str): Directory holding per-run data; when given, the raw and
+            normalized profiles (see run_store) are written there as they are
+            computed, along with their statistics, the input fingerprints and
+            the plot digests of this run, so the results can be
+            served later and an incremental run can build on them.
+        previous (str): Timestamp of the profile's previous run. For profiles
+            in incremental mode, sets whose inputs are unchanged since that run
+            are taken from its state and their plots are reused if unchanged.
+        only_sets (list): Restrict the run to these image set numbers, e.g.
+            to leave out sets that are still being written.
+        incremental (bool): Overrides the profile's incremental setting.
+
+    Returns:
+        timestamp (str): Timestamp identifying the results directory.
+        num_sets (int): Number of image sets in the results.
+        failed (dict): Error message of each image set that could not be
+            processed, by set name.
+    """
+    # The image processing and plotting stack is only loaded once a run needs it
+    from .utils import gastruloid_processing, plot_results
+
+    progress = progress or _noop
+
+    directory = profile['directory']
+    channel_name_responses = channel_suffixes(profile)
+    marker_name_responses = marker_names(profile)
+    options = gastruloid_processing.processing_options(profile['segmentation_mode'], profile['profile_samples'],
+                                                       profile['profile_dtype'], profile['projection'])
+
+    progress('scanning')
+    with instrumentation.stage('scan'):
+        set_numbers = scan_profile(profile).complete_sets
+    if only_sets is not None:
+        wanted = set(only_sets)
+        set_numbers = [n for n in set_numbers if n in wanted]
+    num_sets = len(set_numbers)
+    if not num_sets:
+        raise ValueError(f"No complete image sets found in '{directory}'.")
+
+    # Identity of each set's inputs and settings; unchanged sets keep their profiles
+    with instrumentation.stage('fingerprint'):
+        fingerprints = [
+            gastruloid_processing.cache_key(f"{profile['base_name']}_{n}", directory, channel_name_responses,
+                                            profile['gastruloid_min_size'], options)
+            for n in set_numbers
+        ]
+
+    state = None
+    if incremental is None:
+        incremental = profile['incremental']
+    if incremental and runs_dir and previous:
+        state = _load_state(os.path.join(runs_dir, f"{profile['name']}_{previous}"))
+    previous_rows = {}
+    if state is not None:
+        previous_rows = {
+            int(n): (k, str(fp)) for k, (n, fp) in enumerate(zip(state['set_numbers'], state['fingerprints']))
+        }
+
+    timestamp = _reserve_timestamp(profile['name'], runs_dir)
+    run_dir = os.path.join(runs_dir, f"{profile['name']}_{timestamp}") if runs_dir else None
+    shape = (4, num_sets, options['samples'])
+    dtype = options['dtype']
+
+    # Kept at the profile's precision so reused and freshly computed sets
+    # normalize identically; with a run directory the profiles go straight to disk
+    raw = run_store.create_array(run_dir, 'raw', shape, dtype) if run_dir else np.zeros(shape, dtype)
+    known = {}
+    for k, (n, fp) in enumerate(zip(set_numbers, fingerprints)):
+        if n in previous_rows and previous_rows[n][1] == fp:
+            known[k] = state['raw'][:, previous_rows[n][0]]
+    if state is not None:
+        print(f"Incremental run: {num_sets - len(known)} new or changed of {num_sets} image sets")
+
+    # Maxima and sums are accumulated as each set lands in ``raw``
+    normalizer = normalize.Normalizer(raw)
+    succeeded = set()
+    failed = {}
+
+    def on_result(k):
+        succeeded.add(k)
+        normalizer.update(k)
+
+    def on_error(k, error):
+        failed[k] = str(error)
+
+    progress('segmenting', 0, num_sets - len(known))
+    with instrumentation.stage('process_sets'):
+        gastruloid_processing.process_all_image_sets(
+            num_sets,
+            profile['base_name'],
+            directory,
+            channel_name_responses,
+            marker_name_responses,
+            profile['gastruloid_min_size'],
+            workers=workers,
+            # Known sets are reported first and are not counted as work
+            progress=lambda done, total: progress('segmenting', max(done - len(known), 0), total - len(known)),
+            cache=cache,
+            segmentation=profile['segmentation_mode'],
+            set_numbers=set_numbers,
+            known=known,
+            out=raw,
+            on_result=on_result,
+            on_error=on_error,
+            samples=options['samples'],
+            dtype=dtype,
+            projection=options['projection'],
+        )
+
+    progress('normalizing')
+    print("Normalizing the data to the max intensity of all of the images per channel.")
+    normalized = run_store.create_array(run_dir, 'normalized', shape, dtype) if run_dir else np.empty_like(raw)
+    with instrumentation.stage('normalize'):
+        normalizer.normalize(out=normalized)
+        averages = normalizer.averages()
+        statistics = normalizer.statistics(normalized)
+
+    results_table = gastruloid_processing.new_results_table(profile['base_name'], set_numbers, marker_name_responses)
+    normalize.fill_results_table(results_table, normalized, averages)
+    a_blue, a_red, a_green, a_cyan = normalized
+
+    progress('plotting')
+    results_dir = os.path.join(RESULTS_ROOT, f"{profile['name']}_{timestamp}")
+
+    labels = tuple(marker_name_responses.values())
+    set_digests = [
+        _plot_digest(a_blue[k], a_red[k], a_green[k], a_cyan[k], labels=labels + (results_table[k + 1][0],))
+        for k in range(num_sets)
+    ]
+    average_digest = _plot_digest(a_blue, a_red, a_green, a_cyan, labels=labels)
+
+    # Plots whose data is identical to the previous run are carried over
+    to_plot = list(range(num_sets))
+    plot_averages = True
+    if state is not None:
+        previous_dir = os.path.join(RESULTS_ROOT, f"{profile['name']}_{previous}")
+        previous_digests = {int(n): str(d) for n, d in zip(state['set_numbers'], state['plot_digests'])}
+        to_plot = []
+        for k, n in enumerate(set_numbers):
+            source = os.path.join(previous_dir, f"set_{previous_rows[n][0] + 1}.png") if n in previous_rows else None
+            if previous_digests.get(n) == set_digests[k] and os.path.exists(source):
+                _reuse_plot(source, os.path.join(results_dir, f"set_{k + 1}.png"))
+            else:
+                to_plot.append(k)
+
+        if str(state['average_digest']) == average_digest:
+            average_plots = [f for f in os.listdir(previous_dir) if f.startswith('average_')]
+            for name in average_plots:
+                _reuse_plot(os.path.join(previous_dir, name), os.path.join(results_dir, name))
+            plot_averages = not average_plots
+        print(f"Re-rendering {len(to_plot)} of {num_sets} set plots")
+
+    with instrumentation.stage('plot'):
+        plot_results.run(results_table, a_blue, a_red, a_green, a_cyan, marker_name_responses, num_sets, results_dir,
+                         sets=to_plot, averages=plot_averages, workers=workers)
+
+    if run_dir:
+        with instrumentation.stage('save'):
+            run_store.save_run(
+                run_dir,
+                [row[0] for row in results_table[1:num_sets + 1]],
+                set_numbers,
+                raw,
+                normalized,
+                averages,
+                {'dapi': 'DAPI', **marker_name_responses},
+                statistics,
+            )
+            np.savez(
+                os.path.join(run_dir, 'state.npz'),
+                set_numbers=np.asarray(set_numbers),
+                # Failed sets get no fingerprint so the next run retries them
+                fingerprints=np.asarray([fp if k in succeeded else '' for k, fp in enumerate(fingerprints)]),
+                plot_digests=np.asarray(set_digests),
+                average_digest=np.asarray(average_digest),
+            )
+
+    failed = {f"{profile['base_name']}_{set_numbers[k]}": failed[k] for k in sorted(failed)}
+    return timestamp, num_sets, failed
+
+
+@click.command('segmentation-report')
+@click.argument('profile_name')
+@click.option('--sets', default=5, show_default=True, help='Number of image sets to compare.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the full report as JSON.')
+@with_appcontext
+def segmentation_report_command(profile_name, sets, as_json):
+    """Compare fast and full-resolution segmentation for a profile."""
+    profile = get_db().execute("SELECT * FROM profiles WHERE name = ?", (profile_name,)).fetchone()
+    if profile is None:
+        raise click.ClickException(f"Profile '{profile_name}' not found.")
+
+    from .utils import gastruloid_processing
+
+    set_numbers = scan_profile(profile).complete_sets[:sets]
+    file_names = [f"{profile['base_name']}_{n}" for n in set_numbers]
+
+    report = gastruloid_processing.segmentation_accuracy_report(
+        file_names, profile['directory'], channel_suffixes(profile), marker_names(profile),
+        profile['gastruloid_min_size'], profile['projection']
+    )
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+
+    for row in report['sets']:
+        if 'orientation_error' not in row:
+            click.echo(f"{row['image_set']}: gastruloid found full={row['found_full']} fast={row['found_fast']}")
+            continue
+        click.echo(
+            f"{row['image_set']}: orientation error {row['orientation_error']:.2f} deg, "
+            f"flip {'agrees' if row['flip_agrees'] else 'DIFFERS'}, "
+            f"min profile correlation {min(v for k, v in row.items() if k.endswith('_correlation')):.4f}"
+        )
+    for key, value in report['summary'].items():
+        click.echo(f"{key}: {value}")
+
+
+def init_app(app):
+    app.cli.add_command(segmentation_report_command)
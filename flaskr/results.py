@@ -0,0 +1,358 @@
+import io
+import tempfile
+
+import click
+import numpy as np
+from flask import Blueprint, Response, abort, current_app, render_template, request, send_file, stream_with_context
+from flask.cli import with_appcontext
+
+from . import pipeline
+from .utils import compare, export, instrumentation, normalize, run_store
+from flaskr.db import get_db, get_profile
+
+bp = Blueprint('results', __name__, url_prefix='/results')
+
+
+def get_run(profile_name, timestamp):
+    """Return the finished run for a profile and timestamp, or abort with 404."""
+    run = get_db().execute(
+        "SELECT r.*, p.name AS profile_name FROM runs r JOIN profiles p ON p.id = r.profile_id"
+        " WHERE p.name = ? AND r.timestamp = ? AND r.status = 'done'",
+        (profile_name, timestamp)
+    ).fetchone()
+    if run is None or run['data_dir'] is None:
+        abort(404)
+    return run
+
+
+def _selection(meta):
+    """Parse the channel/set/point query arguments shared by the profile endpoints."""
+    kind = request.args.get('kind', 'normalized')
+    if kind not in ('raw', 'normalized'):
+        abort(400, "kind must be 'raw' or 'normalized'.")
+
+    channels = request.args.getlist('channel') or meta['channels']
+    if any(c not in meta['channels'] for c in channels):
+        abort(400, f"channel must be one of {', '.join(meta['channels'])}.")
+
+    rows = list(range(len(meta['sets'])))
+    if 'set' in request.args:
+        number_to_row = {n: row for row, n in enumerate(meta['set_numbers'])}
+        try:
+            rows = [number_to_row[int(n)] for n in request.args.getlist('set')]
+        except (KeyError, ValueError):
+            abort(400, "set must be image set numbers of this run.")
+
+    points = request.args.get('points', type=int)
+    if points is not None and points < 2:
+        abort(400, "points must be at least 2.")
+    return kind, channels, rows, points
+
+
+def _profiles(run, meta, kind, channels, rows, points):
+    data = run_store.load_array(run['data_dir'], kind)
+    channel_index = [meta['channels'].index(c) for c in channels]
+    # Only the selected channel/set rows of the memory map are read
+    return run_store.resample(data[np.ix_(channel_index, rows)], points)
+
+
+@bp.route('/<profile_name>/<timestamp>/run.json')
+def run_json(profile_name, timestamp):
+    run = get_run(profile_name, timestamp)
+    meta = run_store.load_meta(run['data_dir'])
+    return {
+        'id': run['id'],
+        'profile': profile_name,
+        'timestamp': timestamp,
+        'num_sets': run['num_sets'],
+        **meta,
+    }
+
+
+@bp.route('/<profile_name>/<timestamp>/profiles.json')
+def profiles_json(profile_name, timestamp):
+    run = get_run(profile_name, timestamp)
+    meta = run_store.load_meta(run['data_dir'])
+    kind, channels, rows, points = _selection(meta)
+
+    profiles = _profiles(run, meta, kind, channels, rows, points)
+    averages = run_store.resample(
+        run_store.load_array(run['data_dir'], 'averages')[[meta['channels'].index(c) for c in channels]], points
+    )
+    samples = profiles.shape[-1]
+    return {
+        'kind': kind,
+        'x': np.linspace(0, 1, samples).tolist(),
+        'sets': [meta['sets'][row] for row in rows],
+        'profiles': {c: profiles[k].tolist() for k, c in enumerate(channels)},
+        'averages': {c: averages[k].tolist() for k, c in enumerate(channels)},
+        'labels': {c: meta['labels'].get(c, c) for c in channels},
+    }
+
+
+@bp.route('/<profile_name>/<timestamp>/profiles.npy')
+def profiles_npy(profile_name, timestamp):
+    """Profiles as a .npy array of shape (channels, sets, samples), in the run's stored precision."""
+    run = get_run(profile_name, timestamp)
+    meta = run_store.load_meta(run['data_dir'])
+    kind, channels, rows, points = _selection(meta)
+
+    buffer = io.BytesIO()
+    np.save(buffer, _profiles(run, meta, kind, channels, rows, points))
+    buffer.seek(0)
+    return send_file(
+        buffer, mimetype='application/octet-stream', as_attachment=True,
+        download_name=f"{profile_name}_{timestamp}_{kind}.npy"
+    )
+
+
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+@bp.route('/<profile_name>/<timestamp>/export.<fmt>')
+def export_run(profile_name, timestamp, fmt):
+    """
+    Per-set and average profiles as a CSV, Parquet or XLSX download.
+
+    CSV is streamed set by set; Parquet and XLSX are written to a temporary
+    file first, since neither format can be produced front to back.
+    """
+    if fmt not in export.FORMATS:
+        abort(404)
+    run = get_run(profile_name, timestamp)
+    meta = run_store.load_meta(run['data_dir'])
+    kind, channels, rows, points = _selection(meta)
+    download_name = f"{profile_name}_{timestamp}_{kind}.{fmt}"
+
+    if fmt == 'csv':
+        return Response(
+            stream_with_context(export.iter_csv(run['data_dir'], kind, channels, rows, points)),
+            mimetype=EXPORT_MIMETYPES[fmt],
+            headers={'Content-Disposition': f'attachment; filename="{download_name}"'},
+        )
+
+    writer = export.write_parquet if fmt == 'parquet' else export.write_xlsx
+    output = tempfile.TemporaryFile()
+    try:
+        writer(output, run['data_dir'], kind, channels, rows, points)
+    except export.ExportUnavailable as e:
+        output.close()
+        abort(501, str(e))
+    output.seek(0)
+    return send_file(output, mimetype=EXPORT_MIMETYPES[fmt], as_attachment=True, download_name=download_name)
+
+
+@bp.route('/<profile_name>/<timestamp>/qc/<int:set_number>.png')
+def qc_montage(profile_name, timestamp, set_number):
+    """
+    Segmentation and alignment montage of one image set, rendered from its
+    images on first request with the profile's current settings.
+    """
+    from .utils import qc
+
+    run = get_run(profile_name, timestamp)
+    if set_number not in run_store.load_meta(run['data_dir'])['set_numbers']:
+        abort(404)
+    profile = get_profile(run['profile_id'])
+    file_name = f"{profile['base_name']}_{set_number}"
+    channels = pipeline.channel_suffixes(profile)
+    key = qc.montage_key(file_name, profile['directory'], channels, profile['gastruloid_min_size'],
+                         profile['segmentation_mode'], profile['projection'])
+
+    cache = None
+    if current_app.config['QC_CACHE_DIR']:
+        cache = qc.MontageCache(current_app.config['QC_CACHE_DIR'], current_app.config['QC_CACHE_MAX_BYTES'])
+        png = cache.get(key)
+        if png is not None:
+            return Response(png, mimetype='image/png')
+    try:
+        png = qc.render_montage(file_name, profile['directory'], channels, pipeline.marker_names(profile),
+                                profile['gastruloid_min_size'], profile['segmentation_mode'], profile['projection'])
+    except FileNotFoundError:
+        abort(404)
+    if cache is not None:
+        cache.put(key, png)
+    return Response(png, mimetype='image/png')
+
+
+# Upper bound on bootstrap replicates a request may ask for
+MAX_BOOT = 10000
+
+
+def _comparison():
+    """Load the runs named by the query and compare them (see utils.compare)."""
+    names = request.args.getlist('run')
+    if not names or any('/' not in name for name in names):
+        abort(400, "Give the runs to compare as run=<profile>/<timestamp>, repeated.")
+    runs = [get_run(*name.rsplit('/', 1)) for name in names]
+    metas = [run_store.load_meta(run['data_dir']) for run in runs]
+
+    kind = request.args.get('kind', 'normalized')
+    if kind not in ('raw', 'normalized'):
+        abort(400, "kind must be 'raw' or 'normalized'.")
+    channel = request.args.get('channel', metas[0]['channels'][0])
+    if channel not in metas[0]['channels']:
+        abort(400, f"channel must be one of {', '.join(metas[0]['channels'])}.")
+    points = request.args.get('points', compare.POINTS, type=int)
+    if points < 2:
+        abort(400, "points must be at least 2.")
+    # Runs may have been stored at different resolutions; compare them at the coarsest
+    points = min([points] + [meta['samples'] for meta in metas])
+    n_boot = request.args.get('n_boot', compare.N_BOOT, type=int)
+    if not 1 <= n_boot <= MAX_BOOT:
+        abort(400, f"n_boot must be between 1 and {MAX_BOOT}.")
+    reference = request.args.get('reference', 0, type=int)
+    if not 0 <= reference < len(runs):
+        abort(400, "reference must be the index of one of the runs.")
+
+    groups = [compare.load_group(run['data_dir'], channel, points, kind) for run in runs]
+    try:
+        result = compare.compare(groups, n_boot, request.args.get('ci', compare.CI_LEVEL, type=float), reference,
+                                 request.args.get('seed', 0, type=int))
+    except ValueError as e:
+        abort(400, str(e))
+    return names, metas[0]['labels'].get(channel, channel), np.linspace(0, 1, points), kind, reference, result
+
+
+@bp.route('/compare.json')
+def compare_json():
+    """Bootstrap confidence bands of several runs' mean profiles and their differences to a reference run."""
+    names, label, x, kind, reference, result = _comparison()
+    return {
+        'runs': names,
+        'label': label,
+        'kind': kind,
+        'reference': reference,
+        'x': x.tolist(),
+        'groups': [{name: np.asarray(value).tolist() for name, value in group.items()}
+                   for group in result['groups']],
+        'differences': [{name: np.asarray(value).tolist() for name, value in diff.items()}
+                        for diff in result['differences']],
+    }
+
+
+@bp.route('/compare.png')
+def compare_png():
+    from .utils import plot_results
+
+    names, label, x, kind, reference, result = _comparison()
+    buffer = io.BytesIO()
+    plot_results.render_comparison(buffer, x, names, result, f"{label} ({kind})", reference)
+    return Response(buffer.getvalue(), mimetype='image/png')
+
+
+@bp.route('/<profile_name>/<timestamp>/statistics.json')
+def statistics_json(profile_name, timestamp):
+    """Per-channel mean, SD, SEM and percentile bands of the normalized profiles."""
+    run = get_run(profile_name, timestamp)
+    meta = run_store.load_meta(run['data_dir'])
+    statistics = run_store.load_statistics(run['data_dir'])
+    if statistics is None:
+        abort(404)
+    _, channels, _, points = _selection(meta)
+    channel_index = [meta['channels'].index(c) for c in channels]
+
+    result = {}
+    for name, values in statistics.items():
+        values = run_store.resample(values[channel_index], points)
+        if name == 'percentiles':
+            result[name] = {
+                c: {str(q): band.tolist() for q, band in zip(normalize.PERCENTILES, values[k])}
+                for k, c in enumerate(channels)
+            }
+        else:
+            result[name] = {c: values[k].tolist() for k, c in enumerate(channels)}
+    samples = min(points or meta['samples'], meta['samples'])
+    return {
+        'x': np.linspace(0, 1, samples).tolist(),
+        'labels': {c: meta['labels'].get(c, c) for c in channels},
+        **result,
+    }
+
+
+def _stage_profile(run):
+    records = [dict(row) for row in get_db().execute(
+        "SELECT stage, set_name, wall_seconds, cpu_seconds, peak_bytes FROM run_stages WHERE run_id = ? ORDER BY id",
+        (run['id'],)
+    )]
+    run_records = [r for r in records if r['set_name'] is None]
+    set_records = [r for r in records if r['set_name'] is not None]
+
+    sets = {}
+    for record in set_records:
+        entry = sets.setdefault(record['set_name'], {
+            'set_name': record['set_name'], 'wall_seconds': None, 'cpu_seconds': None, 'peak_bytes': None,
+            'stages': {},
+        })
+        if record['stage'] == 'set':
+            entry.update(wall_seconds=record['wall_seconds'], cpu_seconds=record['cpu_seconds'],
+                         peak_bytes=record['peak_bytes'])
+        else:
+            entry['stages'][record['stage']] = entry['stages'].get(record['stage'], 0) + record['wall_seconds']
+
+    return {
+        'run_id': run['id'],
+        'recorded': bool(records),
+        'stages': instrumentation.summarize(run_records),
+        'set_stages': instrumentation.summarize(set_records),
+        'sets': list(sets.values()),
+    }
+
+
+@bp.route('/<profile_name>/<timestamp>/profile.json')
+def profile_json(profile_name, timestamp):
+    """Stage timings recorded for the run (empty unless INSTRUMENT_RUNS was on)."""
+    return _stage_profile(get_run(profile_name, timestamp))
+
+
+@bp.route('/<profile_name>/<timestamp>/profile')
+def profile(profile_name, timestamp):
+    report = _stage_profile(get_run(profile_name, timestamp))
+    set_stage_names = [summary['stage'] for summary in report['set_stages'] if summary['stage'] != 'set']
+    return render_template('results/profile.html', profile_name=profile_name, timestamp=timestamp,
+                           report=report, set_stage_names=set_stage_names)
+
+
+@click.command('export-run')
+@click.argument('profile_name')
+@click.argument('timestamp')
+@click.option('--format', 'fmt', type=click.Choice(export.FORMATS), default='csv', show_default=True)
+@click.option('--kind', type=click.Choice(('normalized', 'raw')), default='normalized', show_default=True)
+@click.option('--channel', 'channels', multiple=True, type=click.Choice(run_store.CHANNELS),
+              help='Channel to export; repeat for several [default: all].')
+@click.option('--points', type=click.IntRange(min=2), default=None,
+              help='Resample the profiles to this many positions.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default=None,
+              help='Output file [default: <profile>_<timestamp>_<kind>.<format>].')
+@with_appcontext
+def export_run_command(profile_name, timestamp, fmt, kind, channels, points, output):
+    """Export a finished run's per-set and average profiles."""
+    run = get_db().execute(
+        "SELECT r.data_dir FROM runs r JOIN profiles p ON p.id = r.profile_id"
+        " WHERE p.name = ? AND r.timestamp = ? AND r.status = 'done'",
+        (profile_name, timestamp)
+    ).fetchone()
+    if run is None or run['data_dir'] is None:
+        raise click.ClickException(f"No finished run {timestamp} for profile '{profile_name}'.")
+
+    output = output or f"{profile_name}_{timestamp}_{kind}.{fmt}"
+    channels = list(channels) or None
+    try:
+        if fmt == 'csv':
+            with open(output, 'w', newline='') as f:
+                f.writelines(export.iter_csv(run['data_dir'], kind, channels, points=points))
+        else:
+            writer = export.write_parquet if fmt == 'parquet' else export.write_xlsx
+            with open(output, 'wb') as f:
+                writer(f, run['data_dir'], kind, channels, points=points)
+    except export.ExportUnavailable as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Wrote {output}")
+
+
+def init_app(app):
+    app.cli.add_command(export_run_command)
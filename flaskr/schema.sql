@@ -16,3 +16,109 @@ CREATE TABLE profiles (
 );
 
 ALTER TABLE profiles ADD COLUMN gastruloid_min_size INTEGER NOT NULL DEFAULT 6000;
+ALTER TABLE profiles ADD COLUMN segmentation_mode TEXT NOT NULL DEFAULT 'full';
+ALTER TABLE profiles ADD COLUMN incremental INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE profiles ADD COLUMN profile_samples INTEGER NOT NULL DEFAULT 10000;
+ALTER TABLE profiles ADD COLUMN profile_dtype TEXT NOT NULL DEFAULT 'float32';
+ALTER TABLE profiles ADD COLUMN projection TEXT NOT NULL DEFAULT 'none';
+
+-- Bumped on every change to profiles so cached rows can be invalidated
+DROP TABLE IF EXISTS profiles_version;
+
+CREATE TABLE profiles_version (
+    version INTEGER NOT NULL
+);
+
+INSERT INTO profiles_version (version) VALUES (0);
+
+CREATE TRIGGER profiles_inserted AFTER INSERT ON profiles
+BEGIN
+    UPDATE profiles_version SET version = version + 1;
+END;
+
+CREATE TRIGGER profiles_updated AFTER UPDATE ON profiles
+BEGIN
+    UPDATE profiles_version SET version = version + 1;
+END;
+
+CREATE TRIGGER profiles_deleted AFTER DELETE ON profiles
+BEGIN
+    UPDATE profiles_version SET version = version + 1;
+END;
+
+DROP TABLE IF EXISTS runs;
+
+CREATE TABLE runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    profile_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    sets_done INTEGER NOT NULL DEFAULT 0,
+    sets_total INTEGER,
+    timestamp TEXT,
+    num_sets INTEGER,
+    data_dir TEXT,
+    error TEXT,
+    failed_sets TEXT,
+    cache_hits INTEGER NOT NULL DEFAULT 0,
+    cache_misses INTEGER NOT NULL DEFAULT 0,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    started TIMESTAMP,
+    finished TIMESTAMP,
+    input_key TEXT,
+    heartbeat TIMESTAMP,
+    FOREIGN KEY (profile_id) REFERENCES profiles (id)
+);
+
+CREATE INDEX runs_by_input ON runs (profile_id, input_key);
+
+DROP TABLE IF EXISTS run_stages;
+
+CREATE TABLE run_stages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    set_name TEXT,
+    wall_seconds REAL NOT NULL,
+    cpu_seconds REAL NOT NULL,
+    peak_bytes INTEGER,
+    FOREIGN KEY (run_id) REFERENCES runs (id)
+);
+
+DROP TABLE IF EXISTS scanned_directories;
+DROP TABLE IF EXISTS scanned_files;
+
+CREATE TABLE scanned_directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    scanned TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE scanned_files (
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (directory, name)
+);
+
+DROP TABLE IF EXISTS batches;
+DROP TABLE IF EXISTS batch_jobs;
+
+CREATE TABLE batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished TIMESTAMP
+);
+
+CREATE TABLE batch_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch_id INTEGER NOT NULL,
+    profile_id INTEGER NOT NULL,
+    run_id INTEGER,
+    status TEXT NOT NULL DEFAULT 'pending',
+    FOREIGN KEY (batch_id) REFERENCES batches (id),
+    FOREIGN KEY (profile_id) REFERENCES profiles (id),
+    FOREIGN KEY (run_id) REFERENCES runs (id)
+);
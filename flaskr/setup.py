@@ -1,30 +1,31 @@
-import datetime
 import functools
-import os
 
-from .utils import preprocessing, gastruloid_processing, normalize, plot_results
+from . import jobs
+from .utils import options
 from flask import (
     Blueprint, flash, g, redirect, render_template, request, session, url_for
 )
 
-from flaskr.db import get_db
+from flaskr.db import get_db, get_profile
 
 bp = Blueprint('setup', __name__, url_prefix='/setup')
 
 @bp.before_app_request
 def load_profile():
+    # Static files (e.g. the result plots) never need the profile
+    if request.endpoint == 'static':
+        return
+
     profile_id = session.get('profile_id')
 
     if profile_id is None:
         g.profile_id = None
     else:
-        g.profile = get_db().execute(
-            'SELECT * FROM profiles WHERE id = ?', (profile_id,)
-        ).fetchone()
+        g.profile = get_profile(profile_id)
 
 @bp.route('/api/profile/<int:profile_id>')
 def get_profile_json(profile_id):
-    profile = get_db().execute("SELECT * FROM profiles WHERE id = ?", (profile_id,)).fetchone()
+    profile = get_profile(profile_id)
     if not profile:
         return {}, 404
     return dict(profile)
@@ -48,6 +49,11 @@ def prompt():
         base_name = request.form['base_name']
         channels = request.form['channels']
         gastruloid_min_size = int(request.form.get('gastruloid_min_size', 6000))  # fallback to default
+        segmentation_mode = request.form.get('segmentation_mode', 'full')
+        incremental = 1 if request.form.get('incremental') else 0
+        profile_samples = request.form.get('profile_samples', options.DEFAULT_SAMPLES, type=int)
+        profile_dtype = request.form.get('profile_dtype', options.DEFAULT_DTYPE)
+        projection = request.form.get('projection', 'none')
 
 
         dapi_suffix = request.form['dapi_suffix']
@@ -87,6 +93,14 @@ def prompt():
             error = 'cyan_marker is required.'
         elif not gastruloid_min_size:
             error = 'gastruloid_min_size is required.'
+        elif segmentation_mode not in options.SEGMENTATION_MODES:
+            error = 'segmentation_mode must be one of: ' + ', '.join(options.SEGMENTATION_MODES)
+        elif profile_samples is None or profile_samples < 2:
+            error = 'profile_samples must be a whole number of at least 2.'
+        elif profile_dtype not in options.PROFILE_DTYPES:
+            error = 'profile_dtype must be one of: ' + ', '.join(options.PROFILE_DTYPES)
+        elif projection not in options.PROJECTIONS:
+            error = 'projection must be one of: ' + ', '.join(options.PROJECTIONS)
 
         if error is None:
             try:
@@ -96,14 +110,16 @@ def prompt():
                         name, directory, base_name, channels,
                         dapi_suffix, red_suffix, green_suffix, cyan_suffix,
                         red_marker, green_marker, cyan_marker,
-                        gastruloid_min_size
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        gastruloid_min_size, segmentation_mode, incremental,
+                        profile_samples, profile_dtype, projection
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                     """,
                     (
                         profile_name, directory, base_name, channels,
                         dapi_suffix, red_suffix, green_suffix, cyan_suffix,
                         red_marker, green_marker, cyan_marker,
-                        gastruloid_min_size
+                        gastruloid_min_size, segmentation_mode, incremental,
+                        profile_samples, profile_dtype, projection
                     )
                 )
                 db.commit()
@@ -128,71 +144,45 @@ def loading():
         flash("No profile selected or created.")
         return redirect(url_for('setup.prompt'))
 
-    profile = get_db().execute(
-        "SELECT * FROM profiles WHERE id = ?", (profile_id,)
-    ).fetchone()
+    profile = get_profile(profile_id)
 
     return render_template("setup/loading.html", profile=dict(profile))  # Just shows "Loading..." splash
 
 
-@bp.route('/process')
+@bp.route('/process', methods=('POST',))
 def process():
     profile_id = session.get('profile_id')
     if not profile_id:
-        flash("No profile selected or created.")
-        return redirect(url_for('setup.prompt'))
+        return {'error': "No profile selected or created."}, 400
 
-    db = get_db()
-    profile = db.execute("SELECT * FROM profiles WHERE id = ?", (profile_id,)).fetchone()
+    profile = get_profile(profile_id)
     if profile is None:
-        flash("Profile not found.")
-        return redirect(url_for('setup.prompt'))
-
-    directory = profile['directory']
-    channels = int(profile['channels'])
+        return {'error': "Profile not found."}, 404
 
+    # Repeated requests for unchanged inputs follow the existing run
     try:
-        num_sets, image_list = preprocessing.preprocess_directory(directory, channels)
-    except Exception as e:
-        flash(str(e))
-        return redirect(url_for("setup.prompt"))
-
-    channel_name_responses = {
-        'dapi': profile['dapi_suffix'],
-        'red': profile['red_suffix'],
-        'green': profile['green_suffix'],
-        'cyan': profile['cyan_suffix']
-    }
-
-    marker_name_responses = {
-        'red': profile['red_marker'],
-        'green': profile['green_marker'],
-        'cyan': profile['cyan_marker']
-    }
-
-    results_table, blue_int, red_int, green_int, cyan_int = gastruloid_processing.process_all_image_sets(
-        num_sets,
-        profile['base_name'],
-        directory,
-        channel_name_responses,
-        marker_name_responses,
-        profile['gastruloid_min_size'],
-    )
-
-    results_table, a_blue, a_red, a_green, a_cyan = normalize.run(
-        results_table, blue_int, red_int, green_int, cyan_int
-    )
-
-    profile_name = profile['name']
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    results_dir = os.path.join(
-        os.path.dirname(__file__), 'static', 'results', f"{profile_name}_{timestamp}"
-    )
-    os.makedirs(results_dir, exist_ok=True)
-
-    plot_results.run(results_table, a_blue, a_red, a_green, a_cyan, marker_name_responses, num_sets, results_dir)
-
-    return redirect(url_for('show_results', profile_name=profile_name, timestamp=timestamp))
+        run_id, outcome = jobs.submit_run(profile['id'], force=request.args.get('force', type=int) == 1)
+    except FileNotFoundError:
+        return {'error': f"Directory '{profile['directory']}' not found."}, 400
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    data = {'run_id': run_id, 'outcome': outcome, 'status_url': url_for('setup.status', run_id=run_id)}
+    return data, 200 if outcome == 'reused' else 202
+
+
+@bp.route('/status/<int:run_id>')
+def status(run_id):
+    run = get_db().execute(
+        "SELECT r.*, p.name AS profile_name FROM runs r JOIN profiles p ON p.id = r.profile_id WHERE r.id = ?",
+        (run_id,)
+    ).fetchone()
+    if run is None:
+        return {}, 404
+
+    data = jobs.run_status(run)
+    if run['status'] == 'done':
+        data['results_url'] = url_for('show_results', profile_name=run['profile_name'], timestamp=run['timestamp'])
+    return data
 
 @bp.route('/session-debug')
 def session_debug():
@@ -0,0 +1,177 @@
+"""
+Chunked, resumable uploads of image files into a profile's directory.
+
+A file is sent as one or more ``PUT /upload/<profile_id>/<file_name>``
+requests whose body is the next chunk and whose ``Content-Range`` header
+(``bytes <start>-<end>/<total>``) places it; a single request without the
+header sends the whole file. ``GET`` on the same URL returns how many bytes
+have arrived, which is where an interrupted upload resumes.
+
+Chunks are appended to ``<directory>/.uploads/<file_name>.part`` as they
+stream in and the file is moved into the directory once complete, so the
+directory only ever holds whole files. When the last channel of an image
+set arrives the directory listing is refreshed and an incremental run of
+the profile is queued, so analysis proceeds while later sets upload.
+"""
+import os
+import re
+import threading
+
+from flask import Blueprint, abort, request, url_for
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.http import parse_content_range_header
+
+from . import jobs, pipeline
+from .utils import preprocessing
+from flaskr.db import get_profile
+
+bp = Blueprint('upload', __name__, url_prefix='/upload')
+
+# Bytes read from the request stream at a time
+UPLOAD_BLOCK = 1024 * 1024
+
+PARTIAL_DIR = '.uploads'
+
+# One writer per partial file in this process
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _lock(path):
+    with _locks_lock:
+        return _locks.setdefault(path, threading.Lock())
+
+
+def _profile(profile_id):
+    profile = get_profile(profile_id)
+    if profile is None:
+        abort(404)
+    return profile
+
+
+def _set_number(profile, file_name):
+    """Return the image set number of an acceptable file name, or abort with 400."""
+    num_channels = int(profile['channels'])
+    suffixes = pipeline.channel_suffixes(profile)
+    allowed = '|'.join(re.escape(suffixes[c]) for c in preprocessing.CHANNEL_ORDER[:num_channels])
+    match = re.fullmatch(rf"{re.escape(profile['base_name'])}_(\d+)_(?:{allowed})\.tif", file_name)
+    if match is None:
+        abort(400, f"File names must look like {profile['base_name']}_<set>_<suffix>.tif "
+                   f"with one of this profile's channel suffixes.")
+    return int(match.group(1))
+
+
+def _partial_path(profile, file_name):
+    return os.path.join(profile['directory'], PARTIAL_DIR, f"{file_name}.part")
+
+
+def _received(profile, file_name):
+    try:
+        return os.path.getsize(_partial_path(profile, file_name))
+    except FileNotFoundError:
+        return 0
+
+
+def _queue_run(profile):
+    """
+    Queue an incremental run of the profile unless one is already waiting.
+
+    A queued run scans the directory only when it starts, so it also
+    covers sets completed while it waits.
+    """
+    run_id, _ = jobs.submit_run(profile['id'], coalesce=True, incremental=True)
+    return run_id
+
+
+@bp.route('/<int:profile_id>/<file_name>', methods=('GET',))
+def upload_status(profile_id, file_name):
+    """How much of a file has arrived; ``complete`` once it has been moved into the directory."""
+    profile = _profile(profile_id)
+    set_number = _set_number(profile, file_name)
+    path = os.path.join(profile['directory'], file_name)
+    received = _received(profile, file_name)
+    if not received and os.path.exists(path):
+        size = os.path.getsize(path)
+        return {'file': file_name, 'set': set_number, 'received': size, 'total': size, 'complete': True}
+    return {'file': file_name, 'set': set_number, 'received': received, 'total': None, 'complete': False}
+
+
+@bp.route('/<int:profile_id>/<file_name>', methods=('PUT',))
+def upload_chunk(profile_id, file_name):
+    profile = _profile(profile_id)
+    set_number = _set_number(profile, file_name)
+
+    length = request.content_length
+    if length is None:
+        abort(411, "Content-Length is required.")
+    content_range = parse_content_range_header(request.headers.get('Content-Range'))
+    if 'Content-Range' not in request.headers:
+        start, total = 0, length
+    elif content_range is None or content_range.length is None or content_range.start is None:
+        abort(400, "Content-Range must be 'bytes <start>-<end>/<total>'.")
+    else:
+        start, total = content_range.start, content_range.length
+        if content_range.stop - start != length:
+            abort(400, "Content-Range does not match Content-Length.")
+    if start + length > total:
+        abort(400, "Chunk extends past the end of the file.")
+
+    partial = _partial_path(profile, file_name)
+    os.makedirs(os.path.dirname(partial), exist_ok=True)
+    with _lock(partial):
+        received = _received(profile, file_name)
+        if start != received:
+            # Chunks must arrive in order; the client resumes from ``received``
+            return {'file': file_name, 'set': set_number, 'received': received, 'total': total,
+                    'complete': False}, 409
+
+        # Streamed to disk a block at a time; a dropped connection keeps
+        # whatever arrived and the client resumes from there
+        remaining = length
+        with open(partial, 'ab') as f:
+            try:
+                while remaining:
+                    block = request.stream.read(min(UPLOAD_BLOCK, remaining))
+                    if not block:
+                        break
+                    f.write(block)
+                    remaining -= len(block)
+            except ClientDisconnected:
+                pass
+        received = start + length - remaining
+        status = {'file': file_name, 'set': set_number, 'received': received, 'total': total, 'complete': False}
+        if received < total:
+            return status
+        os.replace(partial, os.path.join(profile['directory'], file_name))
+    status['complete'] = True
+
+    # The listing stored for the directory is what runs read their sets from
+    index = pipeline.scan_profile(profile, force=True)
+    if set_number in index.complete_sets:
+        run_id = _queue_run(profile)
+        status.update(set_complete=True, run_id=run_id, status_url=url_for('setup.status', run_id=run_id))
+    else:
+        status.update(set_complete=False, missing=index.incomplete_sets.get(set_number, []))
+    return status, 201
+
+
+@bp.route('/<int:profile_id>', methods=('GET',))
+def upload_overview(profile_id):
+    """Files still uploading, and the profile's complete and incomplete image sets."""
+    profile = _profile(profile_id)
+    partial_dir = os.path.join(profile['directory'], PARTIAL_DIR)
+    partial = {}
+    if os.path.isdir(partial_dir):
+        with os.scandir(partial_dir) as it:
+            partial = {e.name[:-len('.part')]: e.stat().st_size for e in it if e.name.endswith('.part')}
+    try:
+        index = pipeline.scan_profile(profile)
+    except FileNotFoundError:
+        complete, incomplete = [], {}
+    else:
+        complete, incomplete = index.complete_sets, index.incomplete_sets
+    return {
+        'uploading': partial,
+        'complete_sets': complete,
+        'incomplete_sets': {str(n): missing for n, missing in incomplete.items()},
+    }
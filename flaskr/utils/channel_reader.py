@@ -0,0 +1,179 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+
+from .options import PROJECTIONS
+
+
+class ChannelReader:
+    """
+    Lazy reader for one channel TIFF.
+
+    Uncompressed, contiguous files are memory-mapped so that reading a region
+    only touches the pages of the file backing that region. Tiled pages
+    (e.g. stitched mosaics) decode only the tiles overlapping the region.
+    Other files fall back to decoding a single TIFF page on demand. Files
+    with more than one plane (pages, z-slices) expose them through
+    ``num_planes``; with a ``projection`` other than 'none', ``read`` combines
+    them one plane at a time, so memory is bounded by the region read.
+    """
+
+    def __init__(self, path, projection='none'):
+        if projection not in PROJECTIONS:
+            raise ValueError(f"Unknown projection '{projection}'.")
+        self.path = path
+        self._tif = tifffile.TiffFile(path)
+        series = self._tif.series[0]
+        # A trailing 'S' axis holds RGB(A) samples and belongs to the plane
+        plane_ndim = 3 if series.axes.endswith('S') else 2
+        self.shape = tuple(series.shape[-plane_ndim:])
+        self.num_planes = int(np.prod(series.shape[:-plane_ndim], dtype=np.int64))
+        self.projection = projection if self.num_planes > 1 else 'none'
+        # dtype of what ``read`` returns: means are fractional, sums widen
+        if self.projection == 'mean':
+            self.dtype = np.dtype(np.float64)
+        elif self.projection == 'sum':
+            self.dtype = np.dtype(np.int64 if np.issubdtype(series.dtype, np.integer) else np.float64)
+        else:
+            self.dtype = series.dtype
+
+        try:
+            data = tifffile.memmap(path, mode='r')
+        except ValueError:
+            # Compressed or fragmented data cannot be mapped
+            self._data = None
+        else:
+            self._data = data.reshape((self.num_planes,) + self.shape)
+
+    @property
+    def memory_mapped(self):
+        return self._data is not None
+
+    def read(self, region=None, plane=None):
+        """
+        Return ``region`` (a tuple of row/column slices) as an in-memory array.
+
+        Without ``plane`` that is the reader's projection of all planes;
+        otherwise the region of that one plane.
+        """
+        region = region or (slice(None), slice(None))
+        if plane is not None or self.projection == 'none':
+            return self._read_plane(region, plane or 0)
+
+        result = None
+        for plane in range(self.num_planes):
+            data = self._read_plane(region, plane)
+            if result is None:
+                result = data.astype(self.dtype, copy=False)
+            elif self.projection == 'max':
+                np.maximum(result, data, out=result)
+            else:
+                result += data
+        if self.projection == 'mean':
+            result /= self.num_planes
+        return result
+
+    def _read_plane(self, region, plane):
+        if self._data is not None:
+            return np.array(self._data[plane][region])
+        page = self._tif.series[0].pages[plane]
+        if _tiles_readable(page):
+            return _read_tiles(page, region, self.shape)
+        return page.asarray()[region]
+
+    def close(self):
+        self._data = None
+        self._tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _tiles_readable(page):
+    # Tiles of a single 2D plane, with samples (if any) interleaved in each
+    # tile; pages after the first may be TiffFrames sharing the first's tags
+    keyframe = page.keyframe
+    return (keyframe.is_tiled and keyframe.imagedepth == 1
+            and (keyframe.samplesperpixel == 1 or keyframe.planarconfig == 1))
+
+
+def _read_tiles(page, region, shape):
+    """Assemble ``region`` of a tiled page from the tiles that overlap it."""
+    keyframe = page.keyframe
+    rows = range(*region[0].indices(shape[0]))
+    cols = range(*region[1].indices(shape[1]))
+    if rows.step != 1 or cols.step != 1:
+        return page.asarray()[region]
+    out = np.zeros((len(rows), len(cols)) + shape[2:], dtype=keyframe.dtype)
+    if not len(rows) or not len(cols):
+        return out
+
+    tile_rows, tile_cols = keyframe.tilelength, keyframe.tilewidth
+    across = -(-shape[1] // tile_cols)
+    wanted = [
+        r * across + c
+        for r in range(rows.start // tile_rows, (rows.stop - 1) // tile_rows + 1)
+        for c in range(cols.start // tile_cols, (cols.stop - 1) // tile_cols + 1)
+    ]
+    decode_args = {'_fullsize': True}
+    if keyframe.compression in (6, 7, 34892, 33007):  # JPEG variants need their tables
+        decode_args.update(jpegtables=page.jpegtables, jpegheader=keyframe.jpegheader)
+
+    fh = page.parent.filehandle
+    segments = fh.read_segments([page.dataoffsets[i] for i in wanted], [page.databytecounts[i] for i in wanted],
+                                wanted, lock=fh.lock)
+    for data, index in segments:
+        tile, (_, _, top, left, _), _ = keyframe.decode(data, index, **decode_args)
+        if tile is None:
+            # Empty tiles are left as zeros
+            continue
+        tile = tile[0].reshape((tile_rows, tile_cols) + shape[2:])
+        r0, r1 = max(top, rows.start), min(top + tile_rows, rows.stop)
+        c0, c1 = max(left, cols.start), min(left + tile_cols, cols.stop)
+        out[r0 - rows.start:r1 - rows.start, c0 - cols.start:c1 - cols.start] = \
+            tile[r0 - top:r1 - top, c0 - left:c1 - left]
+    return out
+
+
+def warm_file(path, chunk_size=4 * 1024 ** 2):
+    """Read ``path`` once so its contents are in the OS page cache."""
+    buffer = bytearray(chunk_size)
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            while f.readinto(buffer):
+                pass
+    except OSError:
+        pass
+
+
+class Prefetcher:
+    """
+    Warms the page cache for upcoming files on a background thread.
+
+    File reads release the GIL, so disk or network I/O for the next image set
+    overlaps with segmentation of the current one.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        self._seen = set()
+
+    def prefetch(self, paths):
+        for path in paths:
+            if path not in self._seen and os.path.exists(path):
+                self._seen.add(path)
+                self._executor.submit(warm_file, path)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
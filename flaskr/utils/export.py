@@ -0,0 +1,122 @@
+"""
+Export a stored run (see run_store) as CSV, Parquet or XLSX.
+
+CSV and Parquet use a long layout, one row per image set and A-P position
+with a column per channel, followed by the 'Average Results' rows, like the
+MATLAB ``A_Results`` table. XLSX has a sheet per channel with a row per
+position and a column per set, because a long layout of a large run would
+exceed Excel's row limit.
+
+Arrays are read from the memory-mapped .npy files one set (or one block of
+positions) at a time, so memory use does not grow with the number of sets.
+Parquet needs pyarrow and XLSX needs openpyxl; both are optional.
+"""
+import csv
+import io
+
+import numpy as np
+
+from . import run_store
+
+FORMATS = ('csv', 'parquet', 'xlsx')
+
+AVERAGE_NAME = 'Average Results'
+
+# Positions written per block of an XLSX sheet
+XLSX_BLOCK = 1000
+
+
+class ExportUnavailable(Exception):
+    """Raised when the library a format needs is not installed."""
+
+
+def _channel_index(meta, channels):
+    return [meta['channels'].index(c) for c in (channels or meta['channels'])]
+
+
+def _blocks(run_dir, meta, kind, channels, rows, points, average):
+    """Yield ``(image_set, set_number, x, values)`` with values shaped (positions, channels)."""
+    data = run_store.load_array(run_dir, kind)
+    channel_index = _channel_index(meta, channels)
+    rows = range(len(meta['sets'])) if rows is None else rows
+    for row in rows:
+        values = run_store.resample(data[channel_index, row], points)
+        x = np.linspace(0, 1, values.shape[-1])
+        yield meta['sets'][row], meta['set_numbers'][row], x, values.T
+    if average:
+        values = run_store.resample(run_store.load_array(run_dir, 'averages')[channel_index], points)
+        yield AVERAGE_NAME, None, np.linspace(0, 1, values.shape[-1]), values.T
+
+
+def iter_csv(run_dir, kind='normalized', channels=None, rows=None, points=None, average=True):
+    """Yield the CSV text in chunks of one image set."""
+    meta = run_store.load_meta(run_dir)
+    channels = channels or meta['channels']
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerow(['image_set', 'set_number', 'position'] + list(channels))
+    yield buffer.getvalue()
+
+    for image_set, set_number, x, values in _blocks(run_dir, meta, kind, channels, rows, points, average):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow([image_set, '' if set_number is None else set_number, ''])
+        prefix = buffer.getvalue().rstrip('\r\n')
+        buffer = io.StringIO()
+        np.savetxt(buffer, np.column_stack((x, values)), fmt='%.7g', delimiter=',')
+        yield ''.join(prefix + line + '\n' for line in buffer.getvalue().splitlines())
+
+
+def write_parquet(fileobj, run_dir, kind='normalized', channels=None, rows=None, points=None, average=True):
+    """Write the long table to ``fileobj`` as Parquet, one row group per image set."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportUnavailable("Parquet export needs the 'pyarrow' package.")
+
+    meta = run_store.load_meta(run_dir)
+    channels = channels or meta['channels']
+    dtype = pa.from_numpy_dtype(np.dtype(meta.get('dtype', run_store.ARRAY_DTYPE)))
+    schema = pa.schema(
+        [('image_set', pa.string()), ('set_number', pa.int64()), ('position', pa.float64())]
+        + [(c, dtype) for c in channels]
+    )
+    with pq.ParquetWriter(fileobj, schema) as writer:
+        for image_set, set_number, x, values in _blocks(run_dir, meta, kind, channels, rows, points, average):
+            n = len(x)
+            columns = [pa.array([image_set] * n), pa.array([set_number] * n, type=pa.int64()), pa.array(x)]
+            columns += [pa.array(values[:, k], type=dtype) for k in range(values.shape[1])]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+
+def write_xlsx(fileobj, run_dir, kind='normalized', channels=None, rows=None, points=None, average=True):
+    """Write a sheet per channel (positions down, image sets across) to ``fileobj``."""
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise ExportUnavailable("XLSX export needs the 'openpyxl' package.")
+
+    meta = run_store.load_meta(run_dir)
+    channels = channels or meta['channels']
+    rows = list(range(len(meta['sets']))) if rows is None else list(rows)
+    data = run_store.load_array(run_dir, kind)
+    averages = run_store.load_array(run_dir, 'averages')
+    samples = meta['samples']
+    points = samples if points is None else min(points, samples)
+    left, weight = run_store.sample_positions(samples, points)
+    x = np.linspace(0, 1, points)
+
+    # Write-only workbooks stream rows to disk instead of keeping cells in memory
+    workbook = Workbook(write_only=True)
+    for channel, c in zip(channels, _channel_index(meta, channels)):
+        sheet = workbook.create_sheet(meta['labels'].get(channel, channel)[:31])
+        sheet.append(['position'] + [meta['sets'][row] for row in rows] + ([AVERAGE_NAME] if average else []))
+        for start in range(0, points, XLSX_BLOCK):
+            block = slice(start, start + XLSX_BLOCK)
+            l, w = left[block], weight[block]
+            # Only the (sets, positions) block is read from the memory map
+            values = data[c][np.ix_(rows, l)] * (1 - w) + data[c][np.ix_(rows, l + 1)] * w
+            if average:
+                values = np.vstack((values, averages[c, l] * (1 - w) + averages[c, l + 1] * w))
+            for position, column in zip(x[block], values.T.tolist()):
+                sheet.append([float(position)] + column)
+    workbook.save(fileobj)
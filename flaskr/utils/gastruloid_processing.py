@@ -1,136 +1,582 @@
+import functools
+import multiprocessing
 import numpy as np
 import cv2
 import os
-from skimage import io, color, morphology, filters, measure, transform
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from skimage import color, morphology, filters, measure
 from scipy.ndimage import binary_fill_holes
-import matplotlib.pyplot as plt
 
+from . import instrumentation
+from .channel_reader import ChannelReader, Prefetcher
+from .options import ALGORITHM_VERSION, DEFAULT_DTYPE, DEFAULT_SAMPLES, SEGMENTATION_MODES, processing_options
+from .profile_cache import make_key
 
-def process_single_image_set(i, file_name, file_dir, channels, marker_names, min_size):
-    def read_image(channel_suffix):
-        # file_name already includes the base name
-        path = os.path.join(file_dir, f"{file_name}_{channel_suffix}.tif")
+# Downsampling factor used by the 'fast' segmentation mode. Masks are only used
+# for the orientation angle and the flip decision, which survive downsampling.
+FAST_SEGMENTATION_SCALE = 4
+
+# Closing radius used for segmentation at full resolution
+CLOSING_RADIUS = 25
+
+# Margin kept around the DAPI mask when cropping, as a fraction of its size
+# (on top of the closing radius), so signal just outside the mask is kept.
+ROI_MARGIN = 0.05
+
+
+def channel_path(file_dir, file_name, channel_suffix):
+    # file_name already includes the base name
+    return os.path.join(file_dir, f"{file_name}_{channel_suffix}.tif")
+
+
+def segmentation_scale(segmentation):
+    """Downsampling factor masks are computed at for a segmentation mode."""
+    if segmentation not in SEGMENTATION_MODES:
+        raise ValueError(f"Unknown segmentation mode '{segmentation}'.")
+    return FAST_SEGMENTATION_SCALE if segmentation == 'fast' else 1
+
+
+def downsample(gray, scale):
+    """Area-average ``gray`` down by an integer ``scale`` (float32 unless ``scale`` is 1)."""
+    if scale == 1:
+        return gray
+    height, width = gray.shape
+    size = (max(1, width // scale), max(1, height // scale))
+    return cv2.resize(np.asarray(gray, dtype=np.float32), size, interpolation=cv2.INTER_AREA)
+
+
+def _mask(foreground, min_size, scale):
+    # Structuring element and minimum object size shrink with the image so the
+    # mask matches the full-resolution one at the lower sampling rate.
+    radius = max(1, round(CLOSING_RADIUS / scale))
+    return morphology.remove_small_objects(
+        binary_fill_holes(morphology.closing(foreground, _footprint(radius))),
+        max(1, min_size // scale ** 2))
+
+
+@functools.lru_cache(maxsize=None)
+def _footprint(radius):
+    footprint = morphology.disk(radius)
+    footprint.flags.writeable = False
+    return footprint
+
+
+def segment_dapi(blue_gray, min_size, scale=1):
+    """
+    Threshold and clean up a DAPI image.
+
+    Returns:
+        (mask, region): The mask at ``1 / scale`` resolution and its largest
+        region (a skimage RegionProperties), or None if the mask is empty.
+    """
+    small = downsample(blue_gray, scale)
+    blue_bw = _mask(filters.threshold_otsu(small) < small, min_size, scale)
+
+    props = measure.regionprops(blue_bw.astype(int))
+    return blue_bw, max(props, key=lambda x: x.area) if props else None
+
+
+def find_gastruloid(blue_gray, min_size, scale=1):
+    """
+    Locate the gastruloid in a DAPI image.
+
+    Returns:
+        (orientation, bbox): Orientation in degrees and the mask bounding box
+        ``(min_row, min_col, max_row, max_col)`` in full-resolution pixels, or
+        None if no gastruloid is found.
+    """
+    _, largest = segment_dapi(blue_gray, min_size, scale)
+    if largest is None:
+        return None
+    return region_geometry(largest, scale, blue_gray.shape)
+
+
+def region_geometry(region, scale, shape):
+    """Return the orientation (degrees) and full-resolution bounding box of a segment_dapi region."""
+    orientation = region.orientation * 180 / np.pi  # convert to degrees
+    bbox = tuple(min(v * scale, limit) for v, limit in zip(region.bbox, shape * 2))
+    return orientation, bbox
+
+
+def green_centroid(green_gray, min_size, scale=1):
+    """Return the column of the centre of the largest green region, in full-resolution pixels."""
+    small = downsample(green_gray, scale)
+    nonzero = small[small > 0]
+    threshold = 4 * np.mean(nonzero) / 255
+    green_bw = _mask(small > threshold, min_size, scale)
+
+    props = measure.regionprops(measure.label(green_bw))
+    largest_green = max(props, key=lambda x: x.area)
+    return largest_green.centroid[1] * green_gray.shape[1] / small.shape[1]
+
+
+def needs_flip(green_gray, min_size, scale=1, columns=None):
+    """
+    Return True if the green signal sits in the right half of a rotated image.
+
+    ``columns`` is the ``(start, stop)`` column range of the gastruloid; the
+    whole image width is used when it is not given.
+    """
+    start, stop = columns or (0, green_gray.shape[1])
+    rel_pos = (green_centroid(green_gray, min_size, scale) - start) / (stop - start)
+
+    return rel_pos > 0.5
+
+
+def padded_crop(bbox, shape):
+    """Row and column slices of the region cropped around a mask bounding box."""
+    min_row, min_col, max_row, max_col = bbox
+    pad = CLOSING_RADIUS + int(ROI_MARGIN * max(max_row - min_row, max_col - min_col))
+    return (slice(max(0, min_row - pad), min(shape[0], max_row + pad)),
+            slice(max(0, min_col - pad), min(shape[1], max_col + pad)))
+
+
+def _rotate_stack(stack, angle):
+    """Rotate an (H, W, C) float32 stack counter-clockwise, enlarging the canvas to fit."""
+    height, width = stack.shape[:2]
+    centre = ((width - 1) / 2, (height - 1) / 2)
+    matrix = cv2.getRotationMatrix2D(centre, angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    out_width = int(np.ceil(height * sin + width * cos))
+    out_height = int(np.ceil(height * cos + width * sin))
+    matrix[0, 2] += (out_width - 1) / 2 - centre[0]
+    matrix[1, 2] += (out_height - 1) / 2 - centre[1]
+
+    rotated = cv2.warpAffine(stack, matrix, (out_width, out_height), flags=cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return rotated.reshape(out_height, out_width, stack.shape[2])
+
+
+def process_single_image_set(i, file_name, file_dir, channels, marker_names, min_size, segmentation='full',
+                             samples=DEFAULT_SAMPLES, dtype=DEFAULT_DTYPE, projection='none'):
+    profiles, _ = analyse_image_set(file_name, file_dir, channels, marker_names, min_size, segmentation, samples,
+                                    projection)
+    return tuple(profile.astype(dtype, copy=False) for profile in profiles)
+
+
+def analyse_image_set(file_name, file_dir, channels, marker_names, min_size, segmentation='full',
+                      samples=DEFAULT_SAMPLES, projection='none'):
+    """
+    Segment, orient and quantify one image set.
+
+    Multi-plane channel files are reduced to one image by ``projection``
+    (see channel_reader.PROJECTIONS) before segmentation.
+
+    Returns:
+        profiles (tuple): Blue, red, green and cyan intensity profiles, each
+            resampled to ``samples`` points.
+        geometry (dict): ``orientation`` (degrees) and ``flip`` used to align
+            the gastruloid, or None if no gastruloid was found.
+    """
+    scale = segmentation_scale(segmentation)
+
+    def open_image(channel_suffix):
+        path = channel_path(file_dir, file_name, channel_suffix)
         print(f"Reading: {path}")  # Optional debug
         if not os.path.exists(path):
             print(f"Warning: Image file not found: {path}")
-            return np.zeros((1, 1))  # or some default/fallback image
+            return None
 
-        return io.imread(path)
+        return ChannelReader(path, projection)
 
+    # Opened one at a time inside the try, so a failed open still closes the others
+    names = ('dapi', 'red', 'green') + (('cyan',) if 'cyan' in channels else ())
+    readers = []
+    try:
+        for name in names:
+            readers.append(open_image(channels[name]))
+        return _analyse_channels(file_name, readers, marker_names, min_size, scale, samples)
+    finally:
+        for reader in readers:
+            if reader is not None:
+                reader.close()
 
-    blue = read_image(channels['dapi'])
-    red = read_image(channels['red'])
-    green = read_image(channels['green'])
-    cyan = read_image(channels['cyan']) if 'cyan' in channels else None
 
-    blue_gray = color.rgb2gray(blue) if blue.ndim == 3 else blue
-    blue_bw = morphology.remove_small_objects(
-        binary_fill_holes(morphology.closing(
-            filters.threshold_otsu(blue_gray) < blue_gray,
-            morphology.disk(25))), min_size)
+def _analyse_channels(file_name, readers, marker_names, min_size, scale, samples):
+    has_cyan = len(readers) > 3
+    # Only DAPI is read in full; the other channels are read once the ROI is known
+    with instrumentation.stage('read_dapi'):
+        blue = readers[0].read() if readers[0] is not None else np.zeros((1, 1))  # or some default/fallback image
 
-    props = measure.regionprops(blue_bw.astype(int))
-    if not props:
+    blue_gray = to_gray(blue)
+    del blue
+    with instrumentation.stage('segment'):
+        found = find_gastruloid(blue_gray, min_size, scale)
+    if found is None:
         print(f"[SKIPPED] No regions found in DAPI (blue) channel for image set {file_name}.")
         return (
-            np.zeros(10000),  # blue
-            np.zeros(10000),  # red
-            np.zeros(10000),  # green
-            np.zeros(10000)   # cyan
-        )
-    largest = max(props, key=lambda x: x.area)
+            np.zeros(samples),  # blue
+            np.zeros(samples),  # red
+            np.zeros(samples),  # green
+            np.zeros(samples)   # cyan
+        ), None
+    orientation, bbox = found
 
-    orientation = largest.orientation * 180 / np.pi  # convert to degrees
+    stack, sl, flip = align_channels(blue_gray, readers, orientation, bbox, min_size, scale)
+    del blue_gray
 
-    def rotate(im): return transform.rotate(im, -orientation, resize=True, preserve_range=True).astype(im.dtype)
+    with instrumentation.stage('profiles'):
+        col_sums = stack[sl].sum(axis=0, dtype=np.float64)
+        x_scale = np.linspace(0, 1, col_sums.shape[0])
+        x_interp = np.linspace(0, 1, samples)
+        blue_interp, red_interp, green_interp = (np.interp(x_interp, x_scale, col_sums[:, c]) for c in range(3))
+        cyan_interp = np.interp(x_interp, x_scale, col_sums[:, 3]) if has_cyan else np.zeros(samples)
 
-    blue, red, green = map(rotate, (blue, red, green))
-    if cyan is not None:
-        cyan = rotate(cyan)
+    geometry = {'orientation': orientation, 'flip': bool(flip), 'roi': bbox}
+    return (blue_interp, red_interp, green_interp, cyan_interp), geometry
 
-    green_gray = color.rgb2gray(green) if green.ndim == 3 else green
-    nonzero = green_gray[green_gray > 0]
-    threshold = 4 * np.mean(nonzero) / 255
-    green_bw = morphology.remove_small_objects(
-        binary_fill_holes(morphology.closing(
-            green_gray > threshold,
-            morphology.disk(25))), min_size)
 
-    props = measure.regionprops(measure.label(green_bw))
-    largest_green = max(props, key=lambda x: x.area)
-    rel_pos = largest_green.centroid[1] / green.shape[1]
-
-    if rel_pos > 0.5:
-        blue = np.fliplr(blue)
-        red = np.fliplr(red)
-        green = np.fliplr(green)
-        if cyan is not None:
-            cyan = np.fliplr(cyan)
-
-    fig, axes = plt.subplots(3, 2 if cyan is not None else 1, figsize=(10, 10))
-    axes[0, 0].imshow(blue, cmap='gray')
-    axes[0, 0].set_title('DAPI')
-    axes[1, 0].imshow(green, cmap='gray')
-    axes[1, 0].set_title(marker_names['green'])
-    axes[2, 0].imshow(red, cmap='gray')
-    axes[2, 0].set_title(marker_names['red'])
-    if cyan is not None:
-        axes[0, 1].imshow(cyan, cmap='gray')
-        axes[0, 1].set_title(marker_names['cyan'])
-    plt.tight_layout()
-    plt.close(fig)
-
-    def quantify(channel_gs):
-        logical = channel_gs > 0
-        rois = measure.label(logical)
-        props = measure.regionprops(rois)
-        largest_roi = max(props, key=lambda p: p.bbox_area)
-        sl = largest_roi.slice
-        roi = channel_gs[sl]
-        col_sum = roi.sum(axis=0)
-        x_scale = np.linspace(0, 1, len(col_sum))
-        x_interp = np.linspace(0, 1, 10000)
-        return np.interp(x_interp, x_scale, col_sum)
-
-    blue_interp = quantify(color.rgb2gray(blue) if blue.ndim == 3 else blue)
-    red_interp = quantify(color.rgb2gray(red) if red.ndim == 3 else red)
-    green_interp = quantify(color.rgb2gray(green) if green.ndim == 3 else green)
-    cyan_interp = quantify(color.rgb2gray(cyan) if (cyan is not None and cyan.ndim == 3) else cyan) if cyan is not None else np.zeros(10000)
-
-    return blue_interp, red_interp, green_interp, cyan_interp
-
-
-def process_all_image_sets(num_sets, file_name_scheme, file_dir, channels, marker_names, min_size):
+def to_gray(im):
+    """Return ``im`` as a single-channel image, converting RGB if needed."""
+    return color.rgb2gray(im) if im.ndim == 3 else im
+
+
+def align_channels(blue_gray, readers, orientation, bbox, min_size, scale=1):
+    """
+    Crop every channel to the padded DAPI ROI, rotate the gastruloid level and
+    flip it so the green signal is on the left.
+
+    Returns:
+        stack (ndarray): Aligned (H, W, channels) float32 crop, DAPI first.
+        sl (tuple): Row and column slices of the gastruloid in ``stack``.
+        flip (bool): Whether the crop was mirrored.
+    """
+    # Crop every channel to the padded DAPI ROI first and rotate them as one
+    # stack, so only the gastruloid neighbourhood is ever read and resampled.
+    crop = padded_crop(bbox, blue_gray.shape)
+    crop_shape = blue_gray[crop].shape
+    stack = np.empty(crop_shape + (len(readers),), dtype=np.float32)
+    stack[..., 0] = blue_gray[crop]
+    with instrumentation.stage('read_channels'):
+        for c, reader in enumerate(readers[1:], start=1):
+            # A missing or mismatched channel contributes an empty profile
+            if reader is None or reader.shape[:2] != blue_gray.shape[:2]:
+                stack[..., c] = 0
+            else:
+                stack[..., c] = to_gray(reader.read(crop))
+    with instrumentation.stage('rotate'):
+        stack = _rotate_stack(stack, -orientation)
+        if all(np.issubdtype(reader.dtype, np.integer) for reader in readers if reader is not None):
+            # Same truncation as casting the rotated image back to its integer type
+            np.floor(stack, out=stack)
+
+    # One bounding box, from the largest nonzero DAPI region, for all channels
+    with instrumentation.stage('regionprops'):
+        props = measure.regionprops(measure.label(stack[..., 0] > 0))
+        sl = max(props, key=lambda p: p.bbox_area).slice
+
+    with instrumentation.stage('flip'):
+        flip = needs_flip(stack[..., 2], min_size, scale, columns=(sl[1].start, sl[1].stop))
+    if flip:
+        stack = stack[:, ::-1]
+        sl = (sl[0], slice(stack.shape[1] - sl[1].stop, stack.shape[1] - sl[1].start))
+    return stack, sl, bool(flip)
+
+
+def _process_set_worker(i, file_name, file_dir, channels, marker_names, min_size, options, instrument=None):
+    # Runs inside a pool worker; exceptions are returned rather than raised so
+    # one bad image set cannot take down the rest of the run. With
+    # ``instrument`` (Recorder arguments) the set's stage records are returned
+    # too; in-process callers instead record into their active recorder.
+    recorder = instrumentation.Recorder(**instrument) if instrument is not None else None
+    with instrumentation.recording(recorder), instrumentation.image_set(file_name):
+        try:
+            profiles = process_single_image_set(i, file_name, file_dir, channels, marker_names, min_size, **options)
+            result = i, profiles, None
+        except Exception as e:
+            result = i, None, f"{type(e).__name__}: {e}"
+    return result + (recorder.records if recorder is not None else [],)
+
+
+def _warm():
+    # Pool initializer. Forked workers inherit the modules already imported
+    # by the parent; with the spawn or forkserver start methods they are
+    # imported when this function is unpickled. Either way, build the
+    # structuring elements of both segmentation modes up front.
+    for segmentation in SEGMENTATION_MODES:
+        _footprint(max(1, round(CLOSING_RADIUS / segmentation_scale(segmentation))))
+
+
+def _ready():
+    return os.getpid()
+
+
+def pool_context():
+    """
+    Multiprocessing context for worker pools.
+
+    Pools are started from processes that already run threads (the web app's
+    job runner, batch runs), and forking those can copy a lock another thread
+    holds into the child. Workers are forked from a single-threaded fork
+    server instead, which has the processing and plotting modules imported.
+    """
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__, f'{__package__}.plot_results'])
+    return context
+
+
+# Long-lived pool shared by all runs of this process, see start_pool
+_warm_pool = None
+_warm_pool_lock = threading.Lock()
+
+
+def start_pool(workers):
+    """
+    Start a pool of ``workers`` processes that runs image sets of every run.
+
+    The workers are spawned and initialized (modules imported, structuring
+    elements built) before this returns, so the first run does not pay for
+    it. Without a started pool each run creates and tears down its own.
+    """
+    global _warm_pool
+    with _warm_pool_lock:
+        if _warm_pool is not None:
+            return
+        pool = _warm_pool = ProcessPoolExecutor(max_workers=workers, mp_context=pool_context(),
+                                                 initializer=_warm)
+    # Every submit spawns a worker while none is idle
+    for future in [pool.submit(_ready) for _ in range(workers)]:
+        future.result()
+
+
+def stop_pool():
+    global _warm_pool
+    with _warm_pool_lock:
+        pool, _warm_pool = _warm_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def shared_pool():
+    """Return the pool started by start_pool, or None when there is none."""
+    return _warm_pool
+
+
+def _discard_pool(pool):
+    global _warm_pool
+    with _warm_pool_lock:
+        if _warm_pool is pool:
+            _warm_pool = None
+    pool.shutdown(wait=False)
+
+
+def _run_pool(pending, workers, file_names, file_dir, channels, marker_names, min_size, options, instrument=None):
+    """Yield (i, profiles, error, records) for every set index in ``pending``.
+
+    Sets go to the shared pool when one has been started (its size then
+    bounds the processes used, rather than ``workers``), otherwise to a pool
+    of this run. If a worker process dies (segfault, OOM kill) the pool is
+    broken and every unfinished future fails; those sets are resubmitted to
+    a fresh pool a limited number of times before being reported as failed.
+    """
+    pending = list(pending)
+    for attempt in range(3):
+        if not pending:
+            return
+        broken = []
+        futures = {}
+        shared = _warm_pool
+        pool = shared or ProcessPoolExecutor(max_workers=min(workers, len(pending)), mp_context=pool_context(),
+                                             initializer=_warm)
+        try:
+            futures = {
+                pool.submit(_process_set_worker, i, file_names[i],
+                            file_dir, channels, marker_names, min_size, options, instrument): i
+                for i in pending
+            }
+            for future in as_completed(futures):
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    broken.append(futures[future])
+        except BrokenProcessPool:
+            # The shared pool broke in another run before these sets were submitted
+            broken = pending
+        finally:
+            if pool is not shared:
+                pool.shutdown()
+            else:
+                # Sets of an abandoned run should not hold up other runs
+                for future in futures:
+                    future.cancel()
+                if broken:
+                    _discard_pool(shared)
+        pending = sorted(broken)
+        if pending:
+            print(f"Worker pool crashed; retrying {len(pending)} image set(s).")
+
+    for i in pending:
+        yield i, None, "worker process crashed", []
+
+
+def cache_key(file_name, file_dir, channels, min_size, options):
+    paths = [channel_path(file_dir, file_name, suffix) for suffix in channels.values()]
+    return make_key(paths, channels=channels, min_size=min_size, version=ALGORITHM_VERSION, **options)
+
+
+def new_results_table(file_name_scheme, set_numbers, marker_names):
     # Predefine results table
     results_table = [["Image Set", "DAPI", marker_names["red"], marker_names["green"], marker_names["cyan"]]]
-    for _ in range(num_sets + 1):
+    for _ in range(len(set_numbers) + 1):
         results_table.append([None] * 5)
     results_table.append(["Average Results", None, None, None, None])
 
-    # Predefine interpolated intensity arrays
-    blue_interpolate = np.zeros((num_sets, 10000))
-    red_interpolate = np.zeros((num_sets, 10000))
-    green_interpolate = np.zeros((num_sets, 10000))
-    cyan_interpolate = np.zeros((num_sets, 10000))
-
-    # Process each image set
-    for i in range(num_sets):
-        print(f"Processing data set {i + 1}")
-        image_name = f"{file_name_scheme}_{i + 1}"
-        results_table[i + 1][0] = image_name
-
-        blue_interp, red_interp, green_interp, cyan_interp = process_single_image_set(
-            i=i,
-            file_name=image_name,
-            file_dir=file_dir,
-            channels=channels,
-            marker_names=marker_names,
-            min_size=min_size
-        )
-
-        blue_interpolate[i, :] = blue_interp
-        red_interpolate[i, :] = red_interp
-        green_interpolate[i, :] = green_interp
-        cyan_interpolate[i, :] = cyan_interp
-
-    return results_table, blue_interpolate, red_interpolate, green_interpolate, cyan_interpolate
+    # Image set numbers from the file names; row i holds set_numbers[i]
+    for i, number in enumerate(set_numbers):
+        results_table[i + 1][0] = f"{file_name_scheme}_{number}"
+    return results_table
+
+
+def process_all_image_sets(num_sets, file_name_scheme, file_dir, channels, marker_names, min_size, workers=None,
+                           progress=None, cache=None, segmentation='full', set_numbers=None, known=None, out=None,
+                           on_result=None, on_error=None, samples=DEFAULT_SAMPLES, dtype=DEFAULT_DTYPE,
+                           projection='none'):
+    """
+    Args:
+        known (dict): Profiles already available for some set indices (e.g.
+            from a previous run); these sets are neither read nor cached.
+        out (numpy.ndarray): ``(4, num_sets, samples)`` array the profiles are
+            written into. Defaults to a new array of ``samples`` points in
+            ``dtype`` precision.
+        on_result (callable): Called with the set index once its row of
+            ``out`` has been written.
+        on_error (callable): Called with the set index and the error message
+            of a set that could not be processed.
+    """
+    options = processing_options(segmentation, samples, dtype, projection)
+
+    if set_numbers is None:
+        set_numbers = range(1, num_sets + 1)
+    results_table = new_results_table(file_name_scheme, set_numbers, marker_names)
+
+    # Predefine interpolated intensity arrays, one row per set and channel
+    if out is None:
+        out = np.zeros((4, num_sets, options['samples']), dtype=dtype)
+
+    # Sets whose inputs are unchanged since an earlier run are served from the cache
+    keys = {}
+    cached = dict(known or {})
+    if cache is not None:
+        for i in range(num_sets):
+            if i in cached:
+                continue
+            keys[i] = cache_key(results_table[i + 1][0], file_dir, channels, min_size, options)
+            profiles = cache.get(keys[i])
+            if profiles is not None:
+                cached[i] = profiles
+        print(f"Profile cache: {len(cached) - len(known or {})} of {num_sets} image sets reused")
+    pending = [i for i in range(num_sets) if i not in cached]
+
+    prefetcher = Prefetcher()
+
+    def prefetch(k):
+        # Read the k-th pending set's files into the page cache ahead of its turn
+        if k < len(pending):
+            name = results_table[pending[k] + 1][0]
+            prefetcher.prefetch(channel_path(file_dir, name, suffix) for suffix in channels.values())
+
+    if workers is None or workers <= 1 or len(pending) <= 1:
+        # Process each image set
+        def computed():
+            for k, i in enumerate(pending):
+                prefetch(k + 1)
+                print(f"Processing data set {results_table[i + 1][0]}")
+                yield _process_set_worker(i, results_table[i + 1][0], file_dir, channels, marker_names, min_size,
+                                          options)
+    else:
+        print(f"Processing {len(pending)} data sets with {workers} workers")
+        # Workers record their own stages and send them back with the result
+        recorder = instrumentation.active()
+        instrument = {'memory': recorder.memory} if recorder is not None else None
+
+        def computed():
+            # Sets are picked up in submission order, so the set after the
+            # ones in flight is the next to be read
+            prefetch(workers)
+            file_names = {i: results_table[i + 1][0] for i in pending}
+            for n, result in enumerate(_run_pool(pending, workers, file_names, file_dir, channels,
+                                                 marker_names, min_size, options, instrument), start=1):
+                prefetch(workers + n)
+                yield result
+
+    def results():
+        for i, profiles in cached.items():
+            yield i, profiles, None
+        for i, profiles, error, records in computed():
+            if records:
+                instrumentation.active().extend(records)
+            if error is None and cache is not None:
+                cache.put(keys[i], profiles)
+            yield i, profiles, error
+
+    # Results arrive in completion order; the set index keeps rows deterministic.
+    with prefetcher:
+        for done, (i, profiles, error) in enumerate(results(), start=1):
+            if error is not None:
+                print(f"[FAILED] Image set {results_table[i + 1][0]}: {error}")
+                if on_error is not None:
+                    on_error(i, error)
+            else:
+                out[:, i] = profiles
+                if on_result is not None:
+                    on_result(i)
+
+            if progress is not None:
+                progress(done, num_sets)
+
+    return results_table, out[0], out[1], out[2], out[3]
+
+
+def segmentation_accuracy_report(file_names, file_dir, channels, marker_names, min_size, projection='none'):
+    """
+    Compare 'fast' against 'full' segmentation on the same image sets.
+
+    Args:
+        file_names (list): Image set names (base name plus set number).
+
+    Returns:
+        report (dict): Per-set ``sets`` entries with the orientation error in
+            degrees, whether the flip decisions agree and, per channel, the
+            maximum absolute profile difference relative to the full-resolution
+            peak and the Pearson correlation; plus a ``summary`` over all sets.
+    """
+    channel_names = ('dapi', 'red', 'green', 'cyan')
+    rows = []
+    for file_name in file_names:
+        full_profiles, full_geometry = analyse_image_set(file_name, file_dir, channels, marker_names, min_size, 'full',
+                                                         projection=projection)
+        fast_profiles, fast_geometry = analyse_image_set(file_name, file_dir, channels, marker_names, min_size, 'fast',
+                                                         projection=projection)
+
+        row = {'image_set': file_name, 'found_full': full_geometry is not None, 'found_fast': fast_geometry is not None}
+        if full_geometry is not None and fast_geometry is not None:
+            # Orientations are axial, so 90 and -90 degrees describe the same axis
+            diff = abs(full_geometry['orientation'] - fast_geometry['orientation']) % 180
+            row['orientation_error'] = min(diff, 180 - diff)
+            row['flip_agrees'] = full_geometry['flip'] == fast_geometry['flip']
+
+            for name, full, fast in zip(channel_names, full_profiles, fast_profiles):
+                peak = np.max(np.abs(full))
+                row[f'{name}_max_rel_diff'] = float(np.max(np.abs(full - fast)) / peak) if peak else 0.0
+                row[f'{name}_correlation'] = float(np.corrcoef(full, fast)[0, 1]) if np.std(full) and np.std(fast) else 1.0
+        rows.append(row)
+
+    compared = [row for row in rows if 'orientation_error' in row]
+    summary = {
+        'sets': len(rows),
+        'compared': len(compared),
+        'detection_agrees': sum(row['found_full'] == row['found_fast'] for row in rows),
+    }
+    if compared:
+        summary['max_orientation_error'] = max(row['orientation_error'] for row in compared)
+        summary['mean_orientation_error'] = float(np.mean([row['orientation_error'] for row in compared]))
+        summary['flip_agreement'] = sum(row['flip_agrees'] for row in compared) / len(compared)
+        for name in channel_names:
+            summary[f'{name}_worst_rel_diff'] = max(row[f'{name}_max_rel_diff'] for row in compared)
+            summary[f'{name}_min_correlation'] = min(row[f'{name}_correlation'] for row in compared)
+
+    return {'sets': rows, 'summary': summary}
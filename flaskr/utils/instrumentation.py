@@ -0,0 +1,147 @@
+"""
+Per-stage timing hooks.
+
+Code marks its stages with ``with instrumentation.stage('name'):``. Unless a
+Recorder is active (see ``recording``) that is a shared no-op context manager,
+so the hooks cost nothing when instrumentation is off.
+"""
+import contextlib
+import threading
+import time
+import tracemalloc
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class Recorder:
+    """
+    Collects wall time, CPU time and peak traced memory for named stages.
+
+    CPU time is that of the calling thread, so background threads (e.g. other
+    requests) are not counted. Peak memory is taken from tracemalloc when
+    ``memory`` is set; it covers Python and NumPy allocations, not memory
+    allocated inside OpenCV, and tracing slows the run down noticeably.
+
+    Every record is a dict with ``stage``, ``set_name`` (None for whole-run
+    stages), ``wall_seconds``, ``cpu_seconds`` and ``peak_bytes`` (None
+    without memory tracing).
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.records = []
+        self._peaks = []
+        self.set_name = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        tracing = self.memory and tracemalloc.is_tracing()
+        if tracing:
+            if self._peaks:
+                # The enclosing stage keeps the peak reached so far
+                self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            record = {
+                'stage': name,
+                'set_name': self.set_name,
+                'wall_seconds': time.perf_counter() - wall,
+                'cpu_seconds': time.thread_time() - cpu,
+                'peak_bytes': None,
+            }
+            if tracing:
+                peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                record['peak_bytes'] = peak
+            self.records.append(record)
+
+    @contextlib.contextmanager
+    def image_set(self, set_name):
+        """Attribute the stages inside the block to ``set_name``."""
+        previous, self.set_name = self.set_name, set_name
+        try:
+            with self.stage('set'):
+                yield
+        finally:
+            self.set_name = previous
+
+    def extend(self, records):
+        """Add records gathered elsewhere, e.g. in a worker process."""
+        self.records.extend(records)
+
+
+# The active recorder is per thread, so concurrent runs in one process
+# (several job threads) do not record into each other.
+_local = threading.local()
+
+
+def active():
+    return getattr(_local, 'recorder', None)
+
+
+def stage(name):
+    """Time the enclosed block as ``name`` if a Recorder is active."""
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        return _NULL_STAGE
+    return recorder.stage(name)
+
+
+def image_set(set_name):
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        return _NULL_STAGE
+    return recorder.image_set(set_name)
+
+
+@contextlib.contextmanager
+def recording(recorder):
+    """
+    Make ``recorder`` the active recorder for the enclosed block.
+
+    Passing None leaves instrumentation off. Memory tracing is started for
+    the block if the recorder asks for it and nothing else is tracing;
+    tracemalloc is process-wide, so concurrent runs share its peaks.
+    """
+    if recorder is None:
+        yield None
+        return
+    start_tracing = recorder.memory and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    previous, _local.recorder = active(), recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+        if start_tracing:
+            tracemalloc.stop()
+
+
+def summarize(records):
+    """
+    Aggregate records per stage.
+
+    Returns:
+        stages (list): One dict per stage name, in first-seen order, with the
+            number of records, total and maximum wall time, total CPU time and
+            the largest peak memory.
+    """
+    stages = {}
+    for record in records:
+        summary = stages.setdefault(record['stage'], {
+            'stage': record['stage'], 'count': 0, 'wall_seconds': 0.0, 'max_wall_seconds': 0.0,
+            'cpu_seconds': 0.0, 'peak_bytes': None,
+        })
+        summary['count'] += 1
+        summary['wall_seconds'] += record['wall_seconds']
+        summary['max_wall_seconds'] = max(summary['max_wall_seconds'], record['wall_seconds'])
+        summary['cpu_seconds'] += record['cpu_seconds']
+        if record['peak_bytes'] is not None:
+            summary['peak_bytes'] = max(summary['peak_bytes'] or 0, record['peak_bytes'])
+    return list(stages.values())
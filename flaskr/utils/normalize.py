@@ -1,38 +1,113 @@
 import numpy as np
 
-def run(results_table, blue_interpolate, red_interpolate, green_interpolate, cyan_interpolate):
-    num_sets = blue_interpolate.shape[0]
-    print("Normalizing the data to the max intensity of all of the images per channel.")
+# Percentiles reported as bands around the average profile
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# Columns handled at once when normalizing or taking percentiles, which bounds
+# the temporary memory to sets x COLUMN_BLOCK values per channel.
+COLUMN_BLOCK = 1024
+
+
+class Normalizer:
+    """
+    Streaming max-normalization over a stacked ``(channels, sets, samples)`` array.
+
+    Per-channel maxima and per-position sums are updated as each set is
+    written into ``profiles``, so by the time the last set finishes the
+    averages and spreads are known without another pass over the data.
+    ``profiles`` may be a memory-mapped array.
+    """
+
+    def __init__(self, profiles):
+        self.profiles = profiles
+        channels, self.num_sets, samples = profiles.shape
+        self.maxima = np.zeros(channels)
+        self.sums = np.zeros((channels, samples))
+        self.sums_sq = np.zeros((channels, samples))
+
+    def update(self, i, *_):
+        """Account for set ``i`` once its row has been written to ``profiles``."""
+        row = self.profiles[:, i]
+        np.nan_to_num(row, copy=False, nan=0)
+        self.maxima = np.maximum(self.maxima, row.max(axis=1))
+        row = row.astype(np.float64)
+        self.sums += row
+        self.sums_sq += row * row
 
-    blue_interpolate[np.isnan(blue_interpolate)] = 0
-    red_interpolate[np.isnan(red_interpolate)] = 0
-    green_interpolate[np.isnan(green_interpolate)] = 0
-    cyan_interpolate[np.isnan(cyan_interpolate)] = 0
+    def _scale(self):
+        # Channels without any signal are left unscaled
+        return np.where(self.maxima != 0, self.maxima, 1.0)
 
-    blue_all_max = np.max(blue_interpolate)
-    red_all_max = np.max(red_interpolate)
-    green_all_max = np.max(green_interpolate)
-    cyan_all_max = np.max(cyan_interpolate)
+    def normalize(self, out=None):
+        """
+        Write the max-normalized profiles to ``out`` (default: in place).
 
-    a_blue_results = blue_interpolate / blue_all_max if blue_all_max != 0 else blue_interpolate
-    a_red_results = red_interpolate / red_all_max if red_all_max != 0 else red_interpolate
-    a_green_results = green_interpolate / green_all_max if green_all_max != 0 else green_interpolate
-    a_cyan_results = cyan_interpolate / cyan_all_max if cyan_all_max != 0 else cyan_interpolate
+        Returns:
+            out: The normalized ``(channels, sets, samples)`` array.
+        """
+        out = self.profiles if out is None else out
+        scale = self._scale()
+        for c in range(self.profiles.shape[0]):
+            for start in range(0, self.profiles.shape[2], COLUMN_BLOCK):
+                cols = slice(start, start + COLUMN_BLOCK)
+                np.divide(self.profiles[c, :, cols], scale[c], out=out[c, :, cols], casting='unsafe')
+        return out
 
-    blue_col_avg = np.sum(a_blue_results, axis=0) / num_sets
-    red_col_avg = np.sum(a_red_results, axis=0) / num_sets
-    green_col_avg = np.sum(a_green_results, axis=0) / num_sets
-    cyan_col_avg = np.sum(a_cyan_results, axis=0) / num_sets
+    def averages(self):
+        """Mean normalized profile per channel, shape (channels, samples)."""
+        return self.sums / (self._scale()[:, None] * max(self.num_sets, 1))
 
-    results_table[-1][1] = blue_col_avg
-    results_table[-1][2] = red_col_avg
-    results_table[-1][3] = green_col_avg
-    results_table[-1][4] = cyan_col_avg
+    def statistics(self, normalized=None):
+        """
+        Spread of the normalized profiles along the A-P axis.
+
+        Returns:
+            stats (dict): ``mean``, ``sd`` and ``sem`` of shape (channels,
+            samples), and, when the ``normalized`` array is given,
+            ``percentiles`` of shape (channels, len(PERCENTILES), samples).
+        """
+        n = max(self.num_sets, 1)
+        scale = self._scale()[:, None]
+        mean = self.sums / n
+        # Sample variance from the running sums, clipped against rounding
+        variance = np.maximum(self.sums_sq - n * mean * mean, 0) / max(n - 1, 1)
+        sd = np.sqrt(variance) / scale
+        stats = {
+            'mean': mean / scale,
+            'sd': sd,
+            'sem': sd / np.sqrt(n),
+        }
+
+        if normalized is not None:
+            channels, _, samples = normalized.shape
+            percentiles = np.empty((channels, len(PERCENTILES), samples))
+            for c in range(channels):
+                for start in range(0, samples, COLUMN_BLOCK):
+                    cols = slice(start, start + COLUMN_BLOCK)
+                    percentiles[c, :, cols] = np.percentile(normalized[c, :, cols], PERCENTILES, axis=0)
+            stats['percentiles'] = percentiles
+        return stats
+
+
+def fill_results_table(results_table, normalized, averages):
+    """Point the results table rows at per-set views of the normalized array."""
+    for c in range(4):
+        results_table[-1][c + 1] = averages[c]
+    for i in range(normalized.shape[1]):
+        for c in range(4):
+            results_table[i + 1][c + 1] = normalized[c, i]
+    return results_table
+
+
+def run(results_table, blue_interpolate, red_interpolate, green_interpolate, cyan_interpolate):
+    num_sets = blue_interpolate.shape[0]
+    print("Normalizing the data to the max intensity of all of the images per channel.")
 
+    profiles = np.stack([blue_interpolate, red_interpolate, green_interpolate, cyan_interpolate])
+    normalizer = Normalizer(profiles)
     for i in range(num_sets):
-        results_table[i + 1][1] = a_blue_results[i, :]
-        results_table[i + 1][2] = a_red_results[i, :]
-        results_table[i + 1][3] = a_green_results[i, :]
-        results_table[i + 1][4] = a_cyan_results[i, :]
+        normalizer.update(i)
+    normalizer.normalize()
 
-    return results_table, a_blue_results, a_red_results, a_green_results, a_cyan_results
+    fill_results_table(results_table, profiles, normalizer.averages())
+    return results_table, profiles[0], profiles[1], profiles[2], profiles[3]
@@ -0,0 +1,37 @@
+"""
+Analysis settings of a profile and their validation.
+
+Kept apart from gastruloid_processing so that the web app and the CLI can
+validate profiles and compute run keys without importing the image
+processing stack (scikit-image, OpenCV, SciPy), which is only loaded once
+image sets are actually processed.
+"""
+
+# Bump whenever a change alters the profiles produced for the same inputs, so
+# stale entries in the profile cache are no longer matched.
+ALGORITHM_VERSION = 2
+
+
+SEGMENTATION_MODES = ('full', 'fast')
+
+# Points along the A-P axis each profile is resampled to, and the precision it
+# is kept at. A gastruloid is only a few hundred pixels long, so fewer samples
+# or float32 lose little and save memory and I/O on large plates.
+DEFAULT_SAMPLES = 10000
+PROFILE_DTYPES = ('float32', 'float64')
+DEFAULT_DTYPE = 'float32'
+
+# How the planes of a multi-plane file (z-stack, time series) are combined
+# into the single image that is analysed. 'none' keeps the first plane.
+PROJECTIONS = ('none', 'max', 'mean', 'sum')
+
+
+def processing_options(segmentation='full', samples=DEFAULT_SAMPLES, dtype=DEFAULT_DTYPE, projection='none'):
+    """Settings forwarded to process_single_image_set for every set (and part of its cache key)."""
+    if dtype not in PROFILE_DTYPES:
+        raise ValueError(f"Unknown profile dtype '{dtype}'.")
+    if int(samples) < 2:
+        raise ValueError("Profiles need at least 2 samples.")
+    if projection not in PROJECTIONS:
+        raise ValueError(f"Unknown projection '{projection}'.")
+    return {'segmentation': segmentation, 'samples': int(samples), 'dtype': dtype, 'projection': projection}
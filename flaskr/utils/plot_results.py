@@ -1,80 +1,203 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 
+from . import instrumentation
 
-def run(results_table, a_blue, a_red, a_green, a_cyan, marker_names, num_sets, output_dir):
+# Lines are decimated to about this many points before plotting, roughly two
+# per pixel column of the widest (1000 px) figure, so every peak stays visible.
+DISPLAY_POINTS = 2000
+
+
+def decimate(x, y, points=DISPLAY_POINTS):
+    """
+    Min/max decimation of one or more lines sharing ``x``.
+
+    Each of ``points // 2`` buckets along the last axis of ``y`` is reduced
+    to its minimum and maximum, which preserves the visible envelope.
+    """
+    n = y.shape[-1]
+    if n <= points:
+        return x, y
+
+    buckets = points // 2
+    starts = np.linspace(0, n, buckets + 1).astype(int)[:-1]
+    ends = np.append(starts[1:], n) - 1
+
+    x_out = np.empty(2 * buckets)
+    x_out[0::2] = x[starts]
+    x_out[1::2] = x[ends]
+    y_out = np.empty(y.shape[:-1] + (2 * buckets,), dtype=y.dtype)
+    y_out[..., 0::2] = np.minimum.reduceat(y, starts, axis=-1)
+    y_out[..., 1::2] = np.maximum.reduceat(y, starts, axis=-1)
+    return x_out, y_out
+
+
+def _new_figure(**kwargs):
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+# Per-process set figures, keyed by their line styles and labels. Only the
+# line data and title change between sets, so axes, ticks, labels and the
+# layout are built once per worker rather than once per plot. Workers of the
+# shared pool live as long as the app and see every profile's marker names,
+# so only the most recently used figures are kept.
+_set_figures = OrderedDict()
+SET_FIGURES = 4
+
+
+def _render_set(path, title, x, lines):
+    key = tuple((style, label) for _, style, label in lines)
+    if key not in _set_figures:
+        fig = _new_figure(figsize=(10, 4))
+        ax = fig.add_subplot()
+        handles = [ax.plot(x, y, style, label=label)[0] for y, style, label in lines]
+        ax.set_title(title, fontsize=14, weight='bold')
+        ax.set_ylim((0, 1))
+        ax.set_xlabel('Relative Length (Anterior to Posterior)')
+        ax.set_ylabel('Normalized Intensity')
+        fig.tight_layout()
+        _set_figures[key] = fig, ax, handles
+        if len(_set_figures) > SET_FIGURES:
+            _, (evicted, _, _) = _set_figures.popitem(last=False)
+            evicted.clear()
+
+    _set_figures.move_to_end(key)
+    fig, ax, handles = _set_figures[key]
+    for handle, (y, _, _) in zip(handles, lines):
+        handle.set_data(x, y)
+    ax.set_title(title, fontsize=14, weight='bold')
+    # Recomputed for every set so 'best' placement follows the data
+    ax.legend()
+    fig.savefig(path)
+
+
+def _render_average(path, title, color, x, sets, average):
+    fig = _new_figure()
+    ax = fig.add_subplot()
+    # One collection for every set instead of one Line2D per set
+    segments = np.stack([np.broadcast_to(x, sets.shape), sets], axis=-1)
+    ax.add_collection(LineCollection(segments, colors='black', linewidths=0.5))
+    ax.plot(x, average, color=color, linewidth=2)
+    ax.autoscale_view()
+    ax.set_title(title, color=color, fontsize=20)
+    ax.set_xlabel("Relative Length (Anterior to Posterior)")
+    ax.set_ylabel("Normalized Intensity")
+    fig.tight_layout()
+    fig.savefig(path)
+
+
+def render_comparison(fileobj, x, names, comparison, title, reference=0):
+    """
+    Plot a compare.compare result: group means with their confidence bands
+    above, differences to the reference group with theirs below.
+
+    Positions where a difference band excludes zero are marked by a strip
+    per run along the bottom of the lower panel.
+    """
+    fig = _new_figure(figsize=(10, 7))
+    top, bottom = fig.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': (3, 2)})
+    colors = [f"C{k % 10}" for k in range(len(names))]
+
+    for name, group, color in zip(names, comparison['groups'], colors):
+        top.fill_between(x, group['ci_low'], group['ci_high'], color=color, alpha=0.25, linewidth=0)
+        top.plot(x, group['mean'], color=color, label=f"{name} (n={group['n']})")
+    top.set_title(title, fontsize=14, weight='bold')
+    top.set_ylabel('Intensity')
+    # A fixed location; 'best' tests every line and band against every spot
+    top.legend(fontsize=8, loc='upper right')
+
+    bottom.axhline(0, color='black', linewidth=0.8)
+    for k, diff in enumerate(comparison['differences']):
+        color = colors[diff['group']]
+        bottom.fill_between(x, diff['ci_low'], diff['ci_high'], color=color, alpha=0.25, linewidth=0)
+        bottom.plot(x, diff['difference'], color=color)
+        # One strip per run along the bottom edge (y in axes coordinates)
+        significant = np.where(diff['significant'], 0.02 + 0.03 * k, np.nan)
+        bottom.plot(x, significant, color=color, linewidth=3, solid_capstyle='butt',
+                    transform=bottom.get_xaxis_transform())
+    bottom.set_ylabel(f"Difference to {names[reference]}")
+    bottom.set_xlabel('Relative Length (Anterior to Posterior)')
+    # Fixed margins; tight_layout would draw the whole figure an extra time
+    fig.subplots_adjust(left=0.08, right=0.98, top=0.94, bottom=0.08, hspace=0.08)
+    fig.savefig(fileobj, format='png')
+
+
+def _render(task):
+    render, args = task
+    with instrumentation.stage('render_plot'):
+        render(*args)
+
+
+def run(results_table, a_blue, a_red, a_green, a_cyan, marker_names, num_sets, output_dir, sets=None, averages=True,
+        workers=None):
+    """
+    Render the per-set and average plots into ``output_dir``.
+
+    ``sets`` limits the per-set plots to those row indices and ``averages``
+    controls the average plots, so callers can re-render only what changed.
+    With ``workers`` > 1 the figures are rendered in a process pool, the
+    shared one of gastruloid_processing.start_pool when it is running.
+    """
     print("Plotting the histograms.")
-    x = np.linspace(0, 1, 10000)
+    x = np.linspace(0, 1, a_blue.shape[-1])
     os.makedirs(output_dir, exist_ok=True)
 
-    for i in range(num_sets):
+    tasks = []
+    for i in (range(num_sets) if sets is None else sets):
         if np.all(a_blue[i] == 0) and np.all(a_red[i] == 0) and np.all(a_green[i] == 0) and (not marker_names.get("cyan") or np.all(a_cyan[i] == 0)):
             print(f"Skipping plot for set {i + 1} — no data.")
             continue
 
-        fig, ax = plt.subplots(figsize=(10, 4))
-        ax.set_title(results_table[i + 1][0], fontsize=14, weight='bold')
-        ax.plot(x, a_blue[i], 'b', label='DAPI')
-        ax.plot(x, a_red[i], 'r', label=marker_names['red'])
-        ax.plot(x, a_green[i], 'g', label=marker_names['green'])
+        lines = [(a_blue[i], 'b', 'DAPI'), (a_red[i], 'r', marker_names['red']), (a_green[i], 'g', marker_names['green'])]
         if marker_names.get("cyan") and not np.all(a_cyan[i] == 0):
-            ax.plot(x, a_cyan[i], 'c', label=marker_names['cyan'])
-        ax.set_ylim((0, 1))
-        ax.set_xlabel('Relative Length (Anterior to Posterior)')
-        ax.set_ylabel('Normalized Intensity')
-        ax.legend()
-        plt.tight_layout()
+            lines.append((a_cyan[i], 'c', marker_names['cyan']))
+        x_dec, y_dec = decimate(x, np.stack([y for y, _, _ in lines]))
+        lines = [(y, style, label) for y, (_, style, label) in zip(y_dec, lines)]
+
         fig_path = os.path.join(output_dir, f"set_{i + 1}.png")
-        fig.savefig(fig_path)
-        plt.close(fig)
+        tasks.append((_render_set, (fig_path, results_table[i + 1][0], x_dec, lines)))
 
+    if averages:
+        print("Generating final plots.")
+        channels = [
+            (a_blue, results_table[-1][1], "DAPI", 'blue', "average_dapi.png"),
+            (a_red, results_table[-1][2], marker_names['red'], 'red', "average_red.png"),
+            (a_green, results_table[-1][3], marker_names['green'], 'green', "average_green.png"),
+        ]
+        if marker_names.get("cyan"):
+            channels.append((a_cyan, results_table[-1][4], marker_names['cyan'], 'cyan', "average_cyan.png"))
 
-    print("Generating final plots.")
+        for a_results, average, title, color, file_name in channels:
+            x_dec, sets_dec = decimate(x, a_results[:num_sets])
+            _, average_dec = decimate(x, average)
+            tasks.append((_render_average, (os.path.join(output_dir, file_name), title, color, x_dec, sets_dec,
+                                            average_dec)))
 
-    fig, ax = plt.subplots()
-    for i in range(num_sets):
-        ax.plot(x, a_blue[i], color='black', linewidth=0.5)
-    ax.plot(x, results_table[-1][1], color='blue', linewidth=2)
-    ax.set_title("DAPI", color='blue', fontsize=20)
-    ax.set_xlabel("Relative Length (Anterior to Posterior)")
-    ax.set_ylabel("Normalized Intensity")
-    plt.tight_layout()
-    fig.savefig(os.path.join(output_dir, "average_dapi.png"))
-    plt.close(fig)
-
-    fig, ax = plt.subplots()
-    for i in range(num_sets):
-        ax.plot(x, a_red[i], color='black', linewidth=0.5)
-    ax.plot(x, results_table[-1][2], color='red', linewidth=2)
-    ax.set_title(marker_names['red'], color='red', fontsize=20)
-    ax.set_xlabel("Relative Length (Anterior to Posterior)")
-    ax.set_ylabel("Normalized Intensity")
-    plt.tight_layout()
-    fig.savefig(os.path.join(output_dir, "average_red.png"))
-    plt.close(fig)
-
-    fig, ax = plt.subplots()
-    for i in range(num_sets):
-        ax.plot(x, a_green[i], color='black', linewidth=0.5)
-    ax.plot(x, results_table[-1][3], color='green', linewidth=2)
-    ax.set_title(marker_names['green'], color='green', fontsize=20)
-    ax.set_xlabel("Relative Length (Anterior to Posterior)")
-    ax.set_ylabel("Normalized Intensity")
-    plt.tight_layout()
-    fig.savefig(os.path.join(output_dir, "average_green.png"))
-    plt.close(fig)
-
-    if marker_names.get("cyan"):
-        fig, ax = plt.subplots()
-        for i in range(num_sets):
-            ax.plot(x, a_cyan[i], color='black', linewidth=0.5)
-        ax.plot(x, results_table[-1][4], color='cyan', linewidth=2)
-        ax.set_title(marker_names['cyan'], color='cyan', fontsize=20)
-        ax.set_xlabel("Relative Length (Anterior to Posterior)")
-        ax.set_ylabel("Normalized Intensity")
-        plt.tight_layout()
-        fig.savefig(os.path.join(output_dir, "average_cyan.png"))
-        plt.close(fig)
+    if workers and workers > 1 and len(tasks) > 1:
+        from . import gastruloid_processing
+        chunksize = max(1, len(tasks) // (4 * workers))
+        pool = gastruloid_processing.shared_pool()
+        if pool is not None:
+            try:
+                # The pre-warmed workers the image sets ran in
+                list(pool.map(_render, tasks, chunksize=chunksize))
+            except BrokenProcessPool:
+                # Replaced by the next run that finds it broken
+                pool = None
+        if pool is None:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks)),
+                                     mp_context=gastruloid_processing.pool_context()) as pool:
+                list(pool.map(_render, tasks, chunksize=chunksize))
+    else:
+        for task in tasks:
+            _render(task)
 
     print("Analysis complete.")
@@ -1,41 +1,155 @@
 import os
+import re
 from pathlib import Path
 
-def preprocess_directory(directory_path: str, num_channels: int, min_file_size: int = 5000):
+CHANNEL_ORDER = ('dapi', 'red', 'green', 'cyan')
+
+
+class DirectoryIndex:
+    """
+    Image files of a directory grouped into image sets.
+
+    Attributes:
+        sets (dict): ``{set_number: {channel: file_name}}`` for every set with
+            at least one channel file.
+        required (tuple): Channels a set needs to be complete.
+        stray (list): Files that do not match ``{base_name}_{i}_{suffix}.tif``.
+        stats (dict): ``{file_name: (size, mtime_ns)}`` for the set files.
+        small (list): Set files left out for being at most ``min_file_size``
+            bytes, typically files still being written.
+    """
+
+    def __init__(self, directory, sets, required, stray, stats=None, small=()):
+        self.directory = directory
+        self.sets = sets
+        self.required = required
+        self.stray = stray
+        self.stats = stats or {}
+        self.small = list(small)
+
+    def signature(self, set_number):
+        """Sizes and mtimes of a set's files; it changes while any of them is being written."""
+        return tuple(sorted((name,) + self.stats[name] for name in self.sets[set_number].values()))
+
+    @property
+    def complete_sets(self):
+        """Sorted numbers of the sets that have every required channel."""
+        return sorted(n for n, files in self.sets.items() if all(c in files for c in self.required))
+
+    @property
+    def incomplete_sets(self):
+        """``{set_number: [missing channels]}`` for sets lacking a required channel."""
+        return {
+            n: [c for c in self.required if c not in files]
+            for n, files in sorted(self.sets.items())
+            if not all(c in files for c in self.required)
+        }
+
+
+def _scan_files(directory_path):
+    # One scandir pass; DirEntry caches the stat result it needs
+    files = []
+    with os.scandir(directory_path) as it:
+        for entry in it:
+            if entry.is_file():
+                st = entry.stat()
+                files.append((entry.name, st.st_size, st.st_mtime_ns))
+    return files
+
+
+def _load_listing(db, directory_path, mtime_ns):
+    row = db.execute(
+        "SELECT mtime_ns FROM scanned_directories WHERE path = ?", (directory_path,)
+    ).fetchone()
+    if row is None or row['mtime_ns'] != mtime_ns:
+        return None
+    return [
+        (r['name'], r['size'], r['mtime_ns'])
+        for r in db.execute("SELECT name, size, mtime_ns FROM scanned_files WHERE directory = ?", (directory_path,))
+    ]
+
+
+def _store_listing(db, directory_path, mtime_ns, files):
+    db.execute("DELETE FROM scanned_files WHERE directory = ?", (directory_path,))
+    db.executemany(
+        "INSERT INTO scanned_files (directory, name, size, mtime_ns) VALUES (?, ?, ?, ?)",
+        [(directory_path, name, size, mtime) for name, size, mtime in files]
+    )
+    db.execute(
+        "INSERT OR REPLACE INTO scanned_directories (path, mtime_ns, scanned) VALUES (?, ?, CURRENT_TIMESTAMP)",
+        (directory_path, mtime_ns)
+    )
+    db.commit()
+
+
+def list_directory(directory_path: str, db=None, force: bool = False):
     """
-    Preprocess image directory: filter valid image files and count sets.
-    
+    List the regular files of a directory as ``(name, size, mtime_ns)`` tuples.
+
+    When a database connection is given the listing is persisted together
+    with the directory's mtime, and a later call for an unchanged directory
+    costs a single stat. Adding, removing or renaming files updates the
+    directory mtime; a file rewritten in place does not, so pass
+    ``force=True`` when sizes must be current.
+    """
+    if not os.path.isdir(Path(directory_path)):
+        raise FileNotFoundError(f"Directory '{directory_path}' does not exist.")
+
+    directory_path = os.path.abspath(directory_path)
+    mtime_ns = os.stat(directory_path).st_mtime_ns
+
+    if db is not None and not force:
+        files = _load_listing(db, directory_path, mtime_ns)
+        if files is not None:
+            return files
+
+    files = _scan_files(directory_path)
+    if db is not None:
+        _store_listing(db, directory_path, mtime_ns, files)
+    return files
+
+
+def index_directory(directory_path: str, base_name: str, suffixes: dict, num_channels: int,
+                    min_file_size: int = 5000, db=None, force: bool = False):
+    """
+    Group the image files of a directory into image sets by name.
+
     Args:
         directory_path (str): Path to the directory of images.
+        base_name (str): Profile base name; files are ``{base_name}_{i}_{suffix}.tif``.
+        suffixes (dict): Channel name ('dapi', 'red', ...) to file suffix.
         num_channels (int): Number of channels per image set (3 or 4).
-        min_file_size (int): Minimum file size to consider valid (default 5000 bytes).
-        
+        min_file_size (int): Files of this size or smaller are ignored.
+        db: Optional SQLite connection used to persist the directory listing.
+        force (bool): Rescan even if the directory mtime is unchanged.
+
     Returns:
-        num_image_sets (int): Number of image sets found.
-        image_files (list): List of valid image file names (sorted).
+        index (DirectoryIndex): The image sets found in the directory.
     """
-    # Make sure directory exists
-    if not os.path.isdir(Path(directory_path)):
-        raise FileNotFoundError(f"Directory '{directory_path}' does not exist.")
+    if num_channels not in (3, 4):
+        raise ValueError("Number of channels must be 3 or 4.")
+    required = CHANNEL_ORDER[:num_channels]
 
-    # Get all files in directory with file size > 5000 bytes
-    valid_files = [
-        f for f in os.listdir(directory_path)
-        if os.path.isfile(os.path.join(directory_path, f)) and os.path.getsize(os.path.join(directory_path, f)) > min_file_size
-    ]
+    channel_for_suffix = {suffixes[c]: c for c in CHANNEL_ORDER if c in suffixes}
+    pattern = re.compile(rf"^{re.escape(base_name)}_(\d+)_(.+)\.tif$")
 
-    # Sort file list for consistent ordering
-    valid_files.sort()
-
-    # Compute number of image sets
-    num_images = len(valid_files)
-    if num_channels == 4:
-        num_sets = num_images // 4
-    elif num_channels == 3:
-        num_sets = num_images // 3
-        print("Running data analysis for a 3-channel image set.")
-    else:
-        raise ValueError("Number of channels must be 3 or 4.")
+    sets = {}
+    stray = []
+    stats = {}
+    small = []
+    for name, size, mtime_ns in list_directory(directory_path, db=db, force=force):
+        match = pattern.match(name)
+        channel = channel_for_suffix.get(match.group(2)) if match else None
+        if channel is None:
+            stray.append(name)
+        elif size > min_file_size:
+            sets.setdefault(int(match.group(1)), {})[channel] = name
+            stats[name] = (size, mtime_ns)
+        else:
+            small.append(name)
 
-    print(f"Found {num_sets} image sets in: {directory_path}")
-    return num_sets, valid_files
+    index = DirectoryIndex(directory_path, sets, required, sorted(stray), stats, sorted(small))
+    if index.incomplete_sets:
+        print(f"Incomplete image sets in {directory_path}: {index.incomplete_sets}")
+    print(f"Found {len(index.complete_sets)} complete image sets in: {directory_path}")
+    return index
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+def file_identity(path):
+    """Return a cheap identity for a file: (size, mtime_ns), or None if it is missing."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def make_key(paths, **params):
+    """
+    Build a content-addressed cache key for one image set.
+
+    Args:
+        paths (list): Input files of the image set; their size and mtime are
+            part of the key so a rewritten file invalidates the entry.
+        **params: Any settings that influence the computed profiles
+            (channel suffixes, minimum size, algorithm version, ...).
+
+    Returns:
+        key (str): Hex digest identifying the entry.
+    """
+    payload = {
+        'files': [[os.path.basename(p), file_identity(p)] for p in paths],
+        'params': params,
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode('utf8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class ProfileCache:
+    """
+    Size-bounded on-disk LRU cache of per-set intensity profiles.
+
+    Entries are ``.npz`` files named by their key. A file's mtime records when
+    it was last used, so eviction removes the least recently used entries
+    first once the cache grows beyond ``max_bytes``.
+    """
+
+    SUFFIX = '.npz'
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}{self.SUFFIX}")
+
+    def _entries(self):
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(self.SUFFIX):
+                    st = entry.stat()
+                    yield entry.path, st.st_size, st.st_mtime_ns
+
+    def get(self, key):
+        """Return the cached profiles for ``key`` as a tuple of arrays, or None."""
+        path = self._path(key)
+        try:
+            profiles = self._load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            # Missing, evicted by another process, or truncated.
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return profiles
+
+    def put(self, key, profiles):
+        """Store ``profiles`` (a sequence of arrays) under ``key``.
+
+        The cache is only an optimisation, so a failed write (e.g. a full
+        disk) is reported and skipped rather than raised.
+        """
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                self._dump(f, profiles)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"Profile cache: could not store {key}: {e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._size += size
+        if self._size > self.max_bytes:
+            try:
+                self.evict()
+            except OSError as e:
+                print(f"Profile cache: could not evict entries: {e}")
+
+    def _load(self, path):
+        with np.load(path) as data:
+            return tuple(data[name] for name in data.files)
+
+    def _dump(self, f, profiles):
+        np.savez(f, *profiles)
+
+    def evict(self):
+        """Delete least recently used entries until the cache is within 90% of its limit."""
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes': self._size,
+            'max_bytes': self.max_bytes,
+        }
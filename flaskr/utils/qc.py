@@ -0,0 +1,163 @@
+"""
+On-demand quality-control montages for single image sets.
+
+A montage shows how a set was segmented and aligned: the DAPI image with its
+mask, ROI and orientation axis, the aligned crop with the profiled region,
+the green channel with the flip decision, and the remaining channels. It is
+rendered from the image files when asked for, not during runs, and cached as
+PNG in a size-bounded directory.
+"""
+import io
+import math
+import os
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+
+from . import gastruloid_processing as gp
+from .channel_reader import ChannelReader
+from .profile_cache import ProfileCache, make_key
+
+# Longest side of every panel, in pixels
+THUMBNAIL_SIZE = 256
+
+# Bump when the montage layout changes so cached montages are re-rendered
+QC_VERSION = 1
+
+
+class MontageCache(ProfileCache):
+    """LRU cache of rendered montages, stored as ``.png`` files named by their key."""
+
+    SUFFIX = '.png'
+
+    def _load(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _dump(self, f, png):
+        f.write(png)
+
+
+def montage_key(file_name, file_dir, channels, min_size, segmentation, projection='none'):
+    paths = [gp.channel_path(file_dir, file_name, suffix) for suffix in channels.values()]
+    return make_key(paths, channels=channels, min_size=min_size, segmentation=segmentation, projection=projection,
+                    version=gp.ALGORITHM_VERSION, qc_version=QC_VERSION)
+
+
+def _thumbnail(image):
+    """Downsample ``image`` to at most THUMBNAIL_SIZE pixels a side; return it and the factor used."""
+    factor = max(1, math.ceil(max(image.shape[:2]) / THUMBNAIL_SIZE))
+    return gp.downsample(image, factor), factor
+
+
+def _show(ax, image, title):
+    image, factor = _thumbnail(np.asarray(image, dtype=np.float32))
+    nonzero = image[image > 0]
+    low, high = np.percentile(nonzero, (1, 99.5)) if nonzero.size else (0, 1)
+    ax.imshow(image, cmap='gray', vmin=low, vmax=max(high, low + 1e-6))
+    ax.set_title(title, fontsize=9)
+    ax.set_axis_off()
+    return factor
+
+
+def _box(ax, rows, cols, factor, color):
+    ax.add_patch(Rectangle(((cols.start - 0.5) / factor, (rows.start - 0.5) / factor),
+                           (cols.stop - cols.start) / factor, (rows.stop - rows.start) / factor,
+                           fill=False, edgecolor=color, linewidth=1))
+
+
+def render_montage(file_name, file_dir, channels, marker_names, min_size, segmentation='full', projection='none'):
+    """
+    Render the QC montage of one image set.
+
+    Returns:
+        png (bytes): The montage as a PNG image.
+    """
+    scale = gp.segmentation_scale(segmentation)
+    names = [name for name in ('dapi', 'red', 'green', 'cyan') if name in channels]
+    readers = []
+    try:
+        for name in names:
+            path = gp.channel_path(file_dir, file_name, channels[name])
+            readers.append(ChannelReader(path, projection) if os.path.exists(path) else None)
+        if readers[0] is None:
+            raise FileNotFoundError(f"DAPI image of {file_name} not found.")
+        return _render(file_name, readers, marker_names, min_size, scale)
+    finally:
+        for reader in readers:
+            if reader is not None:
+                reader.close()
+
+
+def _render(file_name, readers, marker_names, min_size, scale):
+    blue_gray = gp.to_gray(readers[0].read())
+    mask, region = gp.segment_dapi(blue_gray, min_size, scale)
+
+    columns = max(3, len(readers))
+    fig = Figure(figsize=(3 * columns, 6.4))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(2, columns, squeeze=False)
+    for ax in axes.flat:
+        ax.set_axis_off()
+
+    # Row 1: what segmentation saw
+    factor = _show(axes[0, 0], blue_gray, 'DAPI, mask and orientation')
+    if region is None:
+        axes[0, 1].text(0.5, 0.5, 'No gastruloid found', ha='center', va='center')
+        fig.suptitle(file_name)
+        return _png(fig)
+
+    # The mask is at 1 / scale resolution; place its (further downsampled)
+    # pixel centres on the thumbnail's pixel grid
+    step = max(1, int(factor / scale))
+    small_mask = gp.downsample(mask.astype(np.float32), step)
+    rows, cols = ((np.arange(n) + 0.5) * step * scale / factor - 0.5 for n in small_mask.shape)
+    axes[0, 0].contour(cols, rows, small_mask, levels=[0.5], colors='yellow', linewidths=0.8)
+    orientation, bbox = gp.region_geometry(region, scale, blue_gray.shape)
+    crop = gp.padded_crop(bbox, blue_gray.shape)
+    _box(axes[0, 0], slice(bbox[0], bbox[2]), slice(bbox[1], bbox[3]), factor, 'cyan')
+    _box(axes[0, 0], crop[0], crop[1], factor, 'magenta')
+    # Major axis through the centroid, as in skimage's regionprops example
+    y0, x0 = (v * scale / factor for v in region.centroid)
+    half = region.axis_major_length * scale / factor / 2
+    dx, dy = math.sin(region.orientation) * half, math.cos(region.orientation) * half
+    axes[0, 0].plot((x0 - dx, x0 + dx), (y0 - dy, y0 + dy), color='red', linewidth=1)
+
+    axes[0, 1].imshow(_thumbnail(mask.astype(np.float32))[0], cmap='gray')
+    axes[0, 1].set_title(f"Mask ({region.area * scale ** 2:.0f} px, {orientation:.1f}°)", fontsize=9)
+
+    # Row 2: the aligned crop the profiles are taken from
+    try:
+        stack, sl, flip = gp.align_channels(blue_gray, readers, orientation, bbox, min_size, scale)
+    except ValueError:
+        # No green region above threshold, so there is nothing to base the flip on
+        axes[1, 1].text(0.5, 0.5, f"No {marker_names['green']} region found:\nno flip decision",
+                        ha='center', va='center')
+        fig.suptitle(file_name)
+        return _png(fig)
+    del blue_gray
+    factor = _show(axes[1, 0], stack[..., 0], 'Aligned DAPI, profiled region')
+    _box(axes[1, 0], sl[0], sl[1], factor, 'cyan')
+
+    green = stack[..., 2]
+    factor = _show(axes[1, 1], green, f"{marker_names['green']}: {'flipped' if flip else 'not flipped'}")
+    axes[1, 1].axvline(gp.green_centroid(green, min_size, scale) / factor, color='lime', linewidth=1)
+    axes[1, 1].axvline((sl[1].start + sl[1].stop) / 2 / factor, color='white', linestyle='--', linewidth=0.8)
+
+    for c, name in ((1, 'red'), (3, 'cyan')):
+        if c < len(readers):
+            _show(axes[1, 2 if c == 1 else 3], stack[..., c], marker_names.get(name, name))
+    axes[0, 2].text(0, 0.5, '\n'.join([
+        'yellow: DAPI mask', 'cyan: mask bounding box', 'magenta: cropped ROI',
+        'red: major axis', 'green: marker centroid', 'dashed: gastruloid midpoint',
+    ]), fontsize=8, va='center', transform=axes[0, 2].transAxes)
+    fig.suptitle(file_name)
+    return _png(fig)
+
+
+def _png(fig):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=80)
+    return buffer.getvalue()
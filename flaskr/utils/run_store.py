@@ -0,0 +1,114 @@
+import json
+import os
+
+import numpy as np
+
+CHANNELS = ('dapi', 'red', 'green', 'cyan')
+
+# Arrays are kept as raw .npy files rather than compressed archives so they
+# can be memory-mapped. They are stored in the precision of the run's raw
+# profiles (the profile's dtype setting); ARRAY_DTYPE is the default.
+ARRAY_DTYPE = np.float32
+
+
+def create_array(run_dir, name, shape, dtype=ARRAY_DTYPE):
+    """
+    Create one of the run's arrays as a zero-filled memory map.
+
+    Writing profiles straight into the run directory keeps plates larger
+    than memory workable; ``save_run`` only flushes arrays created this way.
+    """
+    if name not in ('raw', 'normalized'):
+        raise ValueError(f"Unknown array '{name}'.")
+    os.makedirs(run_dir, exist_ok=True)
+    return np.lib.format.open_memmap(os.path.join(run_dir, f"{name}.npy"), mode='w+', dtype=dtype, shape=shape)
+
+
+def _is_stored(array, path):
+    filename = getattr(array, 'filename', None)
+    return filename is not None and os.path.abspath(filename) == os.path.abspath(path)
+
+
+def save_run(run_dir, set_names, set_numbers, raw, normalized, averages, labels, statistics=None):
+    """
+    Persist the numeric results of a run.
+
+    Args:
+        run_dir (str): Directory for this run's files (created if needed).
+        set_names (list): Image set names, one per row.
+        set_numbers (list): Image set numbers from the file names.
+        raw: Un-normalized profiles, shape (channels, sets, samples). Every
+            array is stored in its dtype.
+        normalized: Normalized profiles, shape (channels, sets, samples).
+        averages: Per-channel average profiles, shape (channels, samples).
+        labels (dict): Display label for every channel.
+        statistics (dict): Optional spread of the normalized profiles (see
+            normalize.Normalizer.statistics).
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    dtype = np.asarray(raw).dtype
+    for name, array in (('raw', raw), ('normalized', normalized), ('averages', averages)):
+        path = os.path.join(run_dir, f"{name}.npy")
+        if _is_stored(array, path):
+            array.flush()
+        else:
+            np.save(path, np.asarray(array, dtype=dtype))
+    if statistics is not None:
+        np.savez(os.path.join(run_dir, 'statistics.npz'),
+                 **{name: np.asarray(value, dtype=dtype) for name, value in statistics.items()})
+
+    meta = {
+        'channels': list(CHANNELS),
+        'labels': labels,
+        'sets': list(set_names),
+        'set_numbers': [int(n) for n in set_numbers],
+        'samples': int(np.shape(raw)[-1]),
+        'dtype': np.dtype(dtype).name,
+    }
+    with open(os.path.join(run_dir, 'run.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def load_meta(run_dir):
+    with open(os.path.join(run_dir, 'run.json')) as f:
+        return json.load(f)
+
+
+def load_array(run_dir, name, mmap=True):
+    """Return one of 'raw', 'normalized' or 'averages', memory-mapped by default."""
+    if name not in ('raw', 'normalized', 'averages'):
+        raise ValueError(f"Unknown array '{name}'.")
+    return np.load(os.path.join(run_dir, f"{name}.npy"), mmap_mode='r' if mmap else None)
+
+
+def load_statistics(run_dir):
+    """Return the run's statistics as a dict of arrays, or None for older runs."""
+    try:
+        with np.load(os.path.join(run_dir, 'statistics.npz')) as data:
+            return {name: data[name] for name in data.files}
+    except OSError:
+        return None
+
+
+def resample(profiles, points):
+    """Linearly resample profiles along their last axis to ``points`` samples."""
+    samples = profiles.shape[-1]
+    if points is None or points >= samples:
+        return np.asarray(profiles)
+    # Same weights for every row, so interpolate all rows at once
+    left, weight = sample_positions(samples, points)
+    profiles = np.asarray(profiles)
+    weight = weight.astype(profiles.dtype if np.issubdtype(profiles.dtype, np.floating) else ARRAY_DTYPE)
+    return profiles[..., left] * (1 - weight) + profiles[..., left + 1] * weight
+
+
+def sample_positions(samples, points):
+    """
+    Return the left neighbour index and weight of every resampled point.
+
+    Point ``k`` is ``profile[left[k]] * (1 - weight[k]) + profile[left[k] + 1] * weight[k]``,
+    which is exact when ``points == samples``.
+    """
+    position = np.linspace(0, samples - 1, points)
+    left = np.minimum(position.astype(int), samples - 2)
+    return left, position - left
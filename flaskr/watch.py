@@ -0,0 +1,177 @@
+import os
+import time
+
+import click
+from flask.cli import with_appcontext
+
+from . import jobs, pipeline
+from .utils import preprocessing, run_store
+from flaskr.db import get_db
+
+# Seconds before the sets of a failed run are submitted again
+RETRY_SECONDS = 60
+
+
+class ProfileWatcher:
+    """
+    Tracks the image sets of one profile's directory between polls.
+
+    A complete set is *settled* once the sizes and mtimes of its files have
+    not changed for ``settle`` seconds. A run is due whenever the settled
+    sets differ from the ones the last successful run covered; after a failed
+    run, not before RETRY_SECONDS have passed.
+    """
+
+    def __init__(self, profile, settle, processed=()):
+        self.profile = profile
+        self.settle = settle
+        self.mtime_ns = None
+        self.small = []      # set files too small to count yet
+        self.pending = {}    # set number -> (signature, first seen with it)
+        self.settled = {}    # set number -> signature
+        self.processed = {}  # set number -> signature covered by the last done run
+        self.submitted = {}  # set number -> signature covered by the run in flight
+        # Sets already in the latest finished run are taken as processed
+        # with whatever signature they settle with
+        self.existing = set(processed)
+        self.run_id = None
+        self.retry_at = None
+
+    def poll(self, db, now):
+        """Rescan if anything may have changed; return True if a run is due."""
+        directory = self.profile['directory']
+        mtime_ns = os.stat(directory).st_mtime_ns
+        # Files still being written do not touch the directory mtime, so
+        # keep rescanning while any set has not settled or any set file is
+        # still too small to be counted
+        if mtime_ns == self.mtime_ns and not self.pending and not self.small:
+            return self._due(now)
+        self.mtime_ns = mtime_ns
+
+        index = preprocessing.index_directory(
+            directory, self.profile['base_name'], pipeline.channel_suffixes(self.profile),
+            int(self.profile['channels']), db=db, force=True
+        )
+        self.small = index.small
+        current = {n: index.signature(n) for n in index.complete_sets}
+        for n, signature in current.items():
+            if self.settled.get(n) == signature:
+                continue
+            seen = self.pending.get(n)
+            if seen is None or seen[0] != signature:
+                self.pending[n] = (signature, now)
+            elif now - seen[1] >= self.settle:
+                del self.pending[n]
+                self.settled[n] = signature
+                if n in self.existing:
+                    self.existing.discard(n)
+                    self.processed[n] = signature
+        for sets in (self.pending, self.settled):
+            for n in [n for n in sets if n not in current]:
+                del sets[n]
+        return self._due(now)
+
+    def _due(self, now):
+        if self.retry_at is not None and now < self.retry_at:
+            return False
+        return self.settled != self.processed
+
+    def busy(self, db):
+        return self.run_id is not None and jobs.is_live(db, self.run_id)
+
+
+def _latest_sets(db, profile):
+    run = db.execute(
+        "SELECT data_dir FROM runs WHERE profile_id = ? AND status = 'done' AND data_dir IS NOT NULL"
+        " ORDER BY id DESC LIMIT 1",
+        (profile['id'],)
+    ).fetchone()
+    if run is None:
+        return ()
+    try:
+        return run_store.load_meta(run['data_dir'])['set_numbers']
+    except OSError:
+        return ()
+
+
+def _report(watcher, db):
+    run = db.execute("SELECT * FROM runs WHERE id = ?", (watcher.run_id,)).fetchone()
+    name = watcher.profile['name']
+    if run['status'] == 'done':
+        click.echo(f"{name}: run {run['id']} done, {run['num_sets']} sets -> /results/{name}/{run['timestamp']}")
+        watcher.processed = watcher.submitted
+        watcher.retry_at = None
+    else:
+        # The sets stay unprocessed, so they are submitted again after a while
+        click.echo(f"{name}: run {run['id']} {run['status']}: {run['error']} (retrying in {RETRY_SECONDS}s)")
+        watcher.retry_at = time.monotonic() + RETRY_SECONDS
+    watcher.submitted = {}
+    watcher.run_id = None
+
+
+def watch(profiles, interval=2.0, settle=2.0, workers=None, stop=None):
+    """
+    Poll the profiles' directories and run each profile incrementally over
+    its settled sets whenever they change.
+
+    Runs go through the background job executor, one at a time per profile,
+    and are recorded like runs started from the web. ``stop`` is an optional
+    callable that ends the loop when it returns True.
+    """
+    db = get_db()
+    watchers = [ProfileWatcher(profile, settle, _latest_sets(db, profile)) for profile in profiles]
+
+    while stop is None or not stop():
+        for watcher in watchers:
+            if watcher.run_id is not None and not watcher.busy(db):
+                _report(watcher, db)
+            try:
+                due = watcher.poll(db, time.monotonic())
+            except FileNotFoundError as e:
+                click.echo(f"{watcher.profile['name']}: {e}")
+                continue
+            if not due or watcher.busy(db):
+                continue
+
+            sets = sorted(watcher.settled)
+            new = [n for n in sets if watcher.processed.get(n) != watcher.settled[n]]
+            click.echo(f"{watcher.profile['name']}: processing {len(new)} new or changed of {len(sets)} image sets")
+            # Attaches to (or reuses) a run with the same inputs started elsewhere
+            watcher.run_id, _ = jobs.submit_run(watcher.profile['id'], only_sets=sets, incremental=True,
+                                                workers=workers)
+            watcher.submitted = dict(watcher.settled)
+        time.sleep(interval)
+
+    for watcher in watchers:
+        if watcher.run_id is not None:
+            jobs.wait_for_run(watcher.run_id)
+            _report(watcher, db)
+
+
+@click.command('watch')
+@click.argument('profile_names', nargs=-1, required=True)
+@click.option('--interval', default=2.0, show_default=True, help='Seconds between polls.')
+@click.option('--settle', default=2.0, show_default=True,
+              help='Seconds a set\'s files must stay unchanged before it is processed.')
+@click.option('--workers', type=click.IntRange(min=1), default=None,
+              help='Processes per run [default: PROCESS_WORKERS].')
+@with_appcontext
+def watch_command(profile_names, interval, settle, workers):
+    """Process new image sets of the given profiles as they are acquired."""
+    db = get_db()
+    profiles = []
+    for name in profile_names:
+        profile = db.execute("SELECT * FROM profiles WHERE name = ?", (name,)).fetchone()
+        if profile is None:
+            raise click.ClickException(f"Profile '{name}' not found.")
+        profiles.append(profile)
+
+    click.echo(f"Watching {', '.join(p['directory'] for p in profiles)} (Ctrl+C to stop)")
+    try:
+        watch(profiles, interval, settle, workers)
+    except KeyboardInterrupt:
+        click.echo("Stopped watching.")
+
+
+def init_app(app):
+    app.cli.add_command(watch_command)